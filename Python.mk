@@ -20,13 +20,16 @@ COVER_MIN_PERCENTAGE=70
 
 # Recipes ************************************************************************************
 .PHONY: run-tests build clean beautify publish requirements all-requirements \
-	flake autopep sort-imports relative-imports python-help prepush pull-request
+	flake autopep sort-imports relative-imports python-help prepush pull-request \
+	benchmarks benchmarks-baseline
 
 python-help:
 	@echo "Python options"
 	@echo "-----------------------------------------------------------------------"
 	@echo "python-help:             	This help"
 	@echo "run-tests:               	Run tests with coverage"
+	@echo "benchmarks:              	Run benchmark suite and compare it to the stored baseline"
+	@echo "benchmarks-baseline:     	Run benchmark suite and store it as new baseline"
 	@echo "clean:                   	Clean compiled files"
 	@echo "flake:                   	Run Flake8"
 	@echo "prepush:                 	Helper to run before to push to repo"
@@ -84,6 +87,14 @@ run-tests:
 	@echo "Running unit tests..."
 	pytest -v --cov-report term-missing --cov-fail-under=${COVER_MIN_PERCENTAGE} --cov=${PACKAGE_COVERAGE} --exitfirst tests.py
 
+benchmarks:
+	@echo "Running benchmarks..."
+	python3 benchmarks/suite.py --compare benchmarks/baseline.json
+
+benchmarks-baseline:
+	@echo "Storing benchmarks baseline..."
+	python3 benchmarks/suite.py --output benchmarks/baseline.json
+
 prepush: flake run-tests
 
 pull-request: flake run-tests
@@ -0,0 +1,39 @@
+""" Microbenchmark: nested attribute access on a :class:`Configuration`
+
+Run with ``python benchmarks/access.py`` from the repository root.
+"""
+import sys
+import timeit
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from configure import Configuration  # noqa: E402
+
+NUMBER = 200000
+
+STRUCT = {
+    'db': {
+        'pool': {
+            'size': 10,
+            'timeout': 30,
+        },
+        'host': 'localhost',
+    },
+}
+
+
+def bench(label, cfg):
+    timer = timeit.Timer('cfg.db.pool.size', globals={'cfg': cfg})
+    best = min(timer.repeat(repeat=5, number=NUMBER))
+    print('%-24s %8.1f ns/access' % (label, best / NUMBER * 1e9))
+
+
+def main():
+    bench('unconfigured tree', Configuration.from_dict(STRUCT, configure=False))
+    bench('configured tree', Configuration.from_dict(STRUCT))
+    bench('frozen snapshot', Configuration.from_dict(STRUCT).freeze())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+""" Synthetic configuration generator for the benchmark suite
+
+The tree is ``depth`` levels of mappings with ``width`` children each. Every
+leaf mapping holds ``width`` scalars and a list of ``list_size`` items. Next
+to it are ``refs`` references to leaves, ``factories`` ``!factory:`` entries
+and ``includes`` included files, each of them a leaf-sized mapping.
+
+Run with ``python benchmarks/generate.py directory`` to write the files of
+the default parameters somewhere.
+"""
+import os
+import sys
+from os import path
+
+DEFAULTS = {
+    'width': 6,
+    'depth': 3,
+    'list_size': 10,
+    'refs': 100,
+    'includes': 5,
+    'factories': 50,
+}
+
+
+def leaf_paths(width, depth):
+    """ Dotted paths of the leaf mappings, in document order """
+    paths = ['']
+    for _ in range(depth):
+        paths = ['%s%sn%d' % (p, '.' if p else '', i) for p in paths for i in range(width)]
+    return paths
+
+
+def _leaf(lines, indent, width, list_size):
+    for i in range(width):
+        lines.append('%sk%d: value %d' % (indent, i, i))
+    lines.append('%slist: [%s]' % (indent, ', '.join(str(i) for i in range(list_size))))
+
+
+def _tree(lines, indent, width, depth, list_size):
+    if not depth:
+        _leaf(lines, indent, width, list_size)
+        return
+    for i in range(width):
+        lines.append('%sn%d:' % (indent, i))
+        _tree(lines, indent + '  ', width, depth - 1, list_size)
+
+
+def generate(width=DEFAULTS['width'], depth=DEFAULTS['depth'], list_size=DEFAULTS['list_size'],
+             refs=DEFAULTS['refs'], includes=DEFAULTS['includes'], factories=DEFAULTS['factories']):
+    """ Return the text of the main file and a dict of included file names
+    to their text """
+    lines = ['tree:']
+    _tree(lines, '  ', width, depth, list_size)
+
+    leaves = leaf_paths(width, depth)
+    if refs:
+        lines.append('refs:')
+        for i in range(refs):
+            lines.append('  r%d: !ref:tree.%s.k%d' % (i, leaves[i % len(leaves)], i % width))
+    if factories:
+        lines.append('factories:')
+        for i in range(factories):
+            lines.append('  f%d: !factory:datetime.timedelta' % i)
+            lines.append('    seconds: %d' % i)
+
+    included = {}
+    if includes:
+        lines.append('includes:')
+        for i in range(includes):
+            name = 'include_%d.conf' % i
+            lines.append('  i%d: !include:%s' % (i, name))
+            leaf = []
+            _leaf(leaf, '', width, list_size)
+            included[name] = '\n'.join(leaf) + '\n'
+
+    return '\n'.join(lines) + '\n', included
+
+
+def write(directory, **params):
+    """ Write the generated files in ``directory`` and return the path of
+    the main one """
+    main, included = generate(**params)
+    for name, text in included.items():
+        with open(path.join(directory, name), 'w') as f:
+            f.write(text)
+    filename = path.join(directory, 'main.conf')
+    with open(filename, 'w') as f:
+        f.write(main)
+    return filename
+
+
+if __name__ == '__main__':
+    os.makedirs(sys.argv[1], exist_ok=True)
+    print(write(sys.argv[1]))
@@ -0,0 +1,69 @@
+""" Benchmark: wall time and peak RSS of :meth:`Configuration.from_file` on a
+large generated file
+
+Each mode runs in a fresh interpreter so peak RSS is not shared:
+
+* ``text`` reads the whole file as a string first, the way ``from_file`` used
+  to;
+* ``stream`` is ``from_file`` without interpolation context, the loader reads
+  the file object in chunks;
+* ``ctx`` is ``from_file`` with an interpolation context, streamed the same
+  way and interpolated into string values after parsing.
+
+Run with ``python benchmarks/large_file.py [megabytes]`` from the repository
+root.
+"""
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from configure import Configuration  # noqa: E402
+
+MODES = ('text', 'stream', 'ctx')
+
+
+def generate(filename, megabytes):
+    chunk = ''.join('    key_%d: "value number %d with some padding"\n' % (i, i) for i in range(1000))
+    with open(filename, 'w') as f:
+        section = 0
+        while f.tell() < megabytes * 1024 * 1024:
+            f.write('section_%d:\n' % section)
+            f.write(chunk)
+            section += 1
+
+
+def run(mode, filename):
+    start = time.perf_counter()
+    if mode == 'text':
+        with open(filename) as f:
+            Configuration.from_string(f.read())
+    elif mode == 'stream':
+        Configuration.from_file(filename)
+    else:
+        Configuration.from_file(filename, ctx={'unused': 1})
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('%-6s %8.3f s %8.1f MiB peak RSS' % (mode, elapsed, rss))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = path.join(tmp, 'large.conf')
+        generate(filename, megabytes)
+        print('%d MiB file' % megabytes)
+        for mode in MODES:
+            subprocess.run([sys.executable, __file__, '--run', mode, filename], check=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], sys.argv[3])
+    else:
+        main()
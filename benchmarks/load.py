@@ -0,0 +1,33 @@
+""" Microbenchmark: many small :meth:`Configuration.from_string` calls
+
+Run with ``python benchmarks/load.py`` from the repository root.
+"""
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from configure import Configuration  # noqa: E402
+
+NUMBER = 10000
+
+SOURCE = """
+a: 1
+b: !timedelta 1d
+c:
+    d: [1, 2, 3]
+    e: text
+"""
+
+
+def main():
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        Configuration.from_string(SOURCE)
+    elapsed = time.perf_counter() - start
+    print('%d from_string calls: %.3f s (%.1f us/call)' % (NUMBER, elapsed, elapsed / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+""" Scaling benchmark: :meth:`Configuration.configure` on trees of growing size
+
+Trees are built in memory, so only the configure pass is measured. Time per
+node should stay flat as the tree grows. A deep, narrow tree checks the pass
+does not depend on the recursion limit.
+
+Run with ``python benchmarks/scaling.py`` from the repository root.
+"""
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from configure import Configuration, Obj, Ref  # noqa: E402
+
+SIZES = (10 ** 4, 10 ** 5, 10 ** 6)
+DEPTH = 10 ** 5
+
+
+def wide(nodes):
+    """ Tree of about ``nodes`` nodes: sections of ten mappings holding
+    scalars, a list and a couple of directives """
+    struct = {}
+    count = 0
+    while count < nodes:
+        section = struct['s%d' % len(struct)] = {}
+        for i in range(10):
+            section['m%d' % i] = {
+                'a': 1,
+                'b': 'text',
+                'c': [1, 2, 1, 2, {'d': Ref('..a')}],
+                'e': Obj('os.path'),
+                'f': Ref('.a'),
+            }
+            count += 11
+    return struct, count
+
+
+def deep(depth):
+    struct = node = {}
+    for _ in range(depth):
+        node['n'] = node = {'a': 1}
+    node['b'] = Ref('..a')
+    return struct, depth * 2 + 1
+
+
+def measure(name, struct, nodes):
+    config = Configuration(struct)
+    start = time.perf_counter()
+    config.configure()
+    elapsed = time.perf_counter() - start
+    print('%-8s %9d nodes: %8.3f s (%.0f ns/node)' % (name, nodes, elapsed, elapsed / nodes * 1e9))
+
+
+def main():
+    for size in SIZES:
+        measure('wide', *wide(size))
+    measure('deep', *deep(DEPTH))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+""" Benchmark suite: times the main operations on a synthetic configuration
+
+Reports operations per second and the peak memory allocated by one
+operation (``tracemalloc``) for ``from_string``, ``from_file``,
+``configure``, nested attribute access, ``merge``, ``to_dict``, ``by_ref``,
+``format_config`` and ``dump`` of the generated tree as YAML and JSON.
+
+Run with ``python benchmarks/suite.py`` from the repository root, or
+through ``make benchmarks`` to compare against ``benchmarks/baseline.json``
+(``make benchmarks-baseline`` stores a new one). Pass ``--help`` for the
+generator parameters.
+"""
+import argparse
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from configure import Configuration, format_config  # noqa: E402
+from generate import DEFAULTS, leaf_paths, write  # noqa: E402
+
+# minimum time spent on each measure
+MIN_TIME = 0.2
+REPEAT = 3
+
+
+def operations(filename, params):
+    """ Return ``(name, setup, operation)`` triples, ``setup`` builds the
+    argument given to ``operation`` and is not timed """
+    pwd = path.dirname(filename)
+    with open(filename) as f:
+        text = f.read()
+    config = Configuration.from_file(filename)
+    other = Configuration.from_file(filename)
+    leaf = leaf_paths(params['width'], params['depth'])[-1]
+    attrs = ['tree'] + leaf.split('.') + ['k0']
+    ref = 'tree.%s.k0' % leaf
+
+    def access(cfg):
+        for name in attrs:
+            cfg = getattr(cfg, name)
+        return cfg
+
+    def unconfigured(_):
+        return Configuration.from_string(text, pwd=pwd, configure=False)
+
+    def same(_):
+        return config
+
+    return [
+        ('from_string', None, lambda _: Configuration.from_string(text, pwd=pwd)),
+        ('from_file', None, lambda _: Configuration.from_file(filename)),
+        ('configure', unconfigured, lambda cfg: cfg.configure()),
+        ('access', same, access),
+        ('merge', same, lambda cfg: cfg.merge(other)),
+        ('to_dict', same, lambda cfg: cfg.to_dict()),
+        ('by_ref', same, lambda cfg: cfg.by_ref(ref)),
+        ('format_config', same, format_config),
+        ('dump_yaml', same, lambda cfg: cfg.tree.dump(io.StringIO())),
+        ('dump_json', same, lambda cfg: cfg.tree.dump(io.StringIO(), format='json')),
+    ]
+
+
+def measure(setup, operation):
+    best = 0
+    for _ in range(REPEAT):
+        count = 0
+        elapsed = 0
+        while elapsed < MIN_TIME:
+            arg = setup(None) if setup else None
+            start = time.perf_counter()
+            operation(arg)
+            elapsed += time.perf_counter() - start
+            count += 1
+        best = max(best, count / elapsed)
+
+    arg = setup(None) if setup else None
+    tracemalloc.start()
+    try:
+        operation(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'ops_per_sec': best, 'peak_kib': peak / 1024}
+
+
+def run(params, only=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = write(tmp, **params)
+        for name, setup, operation in operations(filename, params):
+            if only and name not in only:
+                continue
+            results[name] = result = measure(setup, operation)
+            print('%-14s %12.1f ops/s %10.1f KiB peak' % (name, result['ops_per_sec'], result['peak_kib']))
+    return {'params': params, 'python': platform.python_version(), 'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """ Print the change of every result against ``baseline`` and return
+    the names of the ones that regressed by more than ``tolerance`` """
+    if baseline['params'] != report['params']:
+        print('warning: baseline was generated with %s' % baseline['params'])
+    regressions = []
+    print()
+    print('%-14s %10s %10s' % ('', 'speed', 'memory'))
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            print('%-14s %10s' % (name, 'new'))
+            continue
+        speed = result['ops_per_sec'] / base['ops_per_sec']
+        memory = result['peak_kib'] / base['peak_kib'] if base['peak_kib'] else 1
+        regressed = speed < 1 - tolerance or memory > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print('%-14s %9.2fx %9.2fx%s' % (name, speed, memory, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    for name, default in DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=default, dest=name)
+    parser.add_argument('--only', action='append', help='run only this operation, may be repeated')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare results to this baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown or memory growth (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    report = run({name: getattr(args, name) for name in DEFAULTS}, only=args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print('regressions: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,32 +4,55 @@
     ===================================================
 
 """
+import io
+import json
+import logging
 import os
+import pickle
 import re
 import sys
+from asyncio import gather, get_running_loop
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 try:
     from collections.abc import Mapping, MutableMapping
 except ImportError:  # pragma: no cover
     from collections import Mapping, MutableMapping
 
+from copy import deepcopy
 from datetime import timedelta
-from inspect import signature
+from functools import lru_cache, partial
+from hashlib import blake2b
+from heapq import heappush, heappushpop
+from inspect import isawaitable, signature
 from os import path
 from re import compile as re_compile
-from types import FunctionType
+from select import select
+from string import Formatter
+from threading import Event, Lock, Thread
+from time import perf_counter
 
 try:
+    from yaml import CSafeDumper as Dumper
     from yaml import CSafeLoader as Loader
 except ImportError:  # pragma: no cover
     from yaml import Loader
+    from yaml import SafeDumper as Dumper
+
+from yaml import dump as yaml_dump
 
 __all__ = (
-    "Configuration", "ConfigurationError", "configure_logging",
-    "format_config", "print_config", "import_string", "ImportStringError")
+    "Configuration", "ConfigurationError", "ConfigurationDiff", "FrozenConfiguration", "OverlayConfiguration",
+    "IncludeGraph",
+    "ConfigWatcher",
+    "ParsedFileCache", "CompiledFileCache", "Tracer", "SlowestTracer",
+    "configure_logging", "format_config", "write_config", "print_config", "import_string", "ImportStringError")
 
 __version__ = '0.6.3'
 
+logger = logging.getLogger(__name__)
+
 
 class ConfigurationError(ValueError):
     """ Configuration error"""
@@ -43,23 +66,56 @@ class Configuration(MutableMapping):
     :class:`collections.MutableMapping` protocol.
     """
 
+    __slots__ = ('_pwd', '_parent', '__struct', '_children', '_source', '_session', '_environment')
+
     _constructors = {}
     _implicit_resolvers = {}
     _multi_constructors = {}
 
+    _loader_cache_size = 32
+    _file_cache = None
+    _disk_cache = None
+    _tracer = None
+
     def __init__(self, struct=None, pwd=None, parent=None):
         self._pwd = pwd or "."
         self._parent = parent
         self.__struct = struct
+        # child views by key, built on first access of a dict value
+        self._children = None
+        # file this configuration was read from, if any
+        self._source = None
+        # state shared with included files while configuring, roots only
+        self._session = None
+        # _Environment snapshot of the load, roots only
+        self._environment = None
 
     def merge(self, config):
         """ Produce new configuration by merging ``config`` object into this
         one"""
-        new = self.__class__({}, parent=self._parent, pwd=self._pwd)
-        new._merge(self)
-        new._merge(config)
+        new = self.merge_all((self, config))
+        new._parent = self._parent
         return new
 
+    def overlay(self, changes=None):
+        """ Return an :class:`OverlayConfiguration` with ``changes`` (a
+        mapping or configuration) deep merged over this one, without
+        copying it """
+        return OverlayConfiguration(self, changes)
+
+    @classmethod
+    def merge_all(cls, configs):
+        """ Produce new configuration by deep merging ``configs``
+        (configurations or mappings, later ones win) in a single pass
+
+        Merged mappings are new, other values are shared with ``configs``.
+        It takes the working directory of the first configuration.
+        """
+        configs = [_resolve_pending(c) for c in configs]
+        pwd = next((c._pwd for c in configs if isinstance(c, Configuration)), None)
+        structs = [s for s in map(_unwrap, configs) if s is not None]
+        return cls(_merge_structs(structs), pwd=pwd)
+
     @property
     def _root(self):
         c = self
@@ -67,6 +123,27 @@ class Configuration(MutableMapping):
             c = c._parent
         return c
 
+    @property
+    def include_graph(self):
+        """ :class:`IncludeGraph` of the files pulled in while configuring,
+        ``None`` before :meth:`configure` ran """
+        session = self._root._session
+        return session.graph if session is not None else None
+
+    @property
+    def env_dependencies(self):
+        """ Environment variables (``!envvar``, ``ENV:`` values) read while
+        loading this configuration and the files it includes, mapped to the
+        value used, ``None`` for variables that were not set """
+        environment = self._root._environment
+        return dict(environment.values) if environment is not None else {}
+
+    def env_changed(self):
+        """ Whether a variable of :attr:`env_dependencies` has another value
+        in ``os.environ`` now, when it does not the configuration would load
+        the same """
+        return _env_changed(self.env_dependencies)
+
     # Iterable
     def __iter__(self):
         if self.__struct is None:
@@ -91,14 +168,54 @@ class Configuration(MutableMapping):
             raise ConfigurationError("unconfigured")
         data = self.__struct[name]
         if isinstance(data, dict):
-            return self.__class__(data, parent=self, pwd=self._pwd)
+            return self._child(name, data)
+        if data.__class__ is _Thunk:
+            data = self._force(name, data)
+            if isinstance(data, dict):
+                return self._child(name, data)
         return data
 
+    def _force(self, name, thunk):
+        """ Resolve the value left pending at ``name`` by a lazy
+        :meth:`configure` and store it in place """
+        session = self._root._session
+        resolving = session.resolving if session is not None else {}
+        marker = _enter(resolving, self, name, name)
+        try:
+            tracer = Configuration._tracer
+            if tracer is None:
+                value = _configure_value(thunk.value, self)
+            else:
+                value = _trace(tracer, 'directive', str(thunk.value), _dotted(_view_path(self) + (name,)),
+                               _view_source(self), _configure_value, thunk.value, self)
+        finally:
+            del resolving[marker]
+        self[name] = value
+        return value
+
+    def _child(self, name, data):
+        """ Return the cached view over the ``data`` dict stored at ``name``
+
+        A cached view is only reused while it still wraps the very same dict,
+        so the underlying struct being changed behind our back is harmless.
+        """
+        children = self._children
+        if children is None:
+            children = self._children = {}
+        else:
+            child = children.get(name)
+            if child is not None and child.__struct is data:
+                return child
+        child = children[name] = self.__class__(data, parent=self, pwd=self._pwd)
+        return child
+
     # MutableMapping
     def __setitem__(self, name, value):
         if self.__struct is None:
             raise ConfigurationError("unconfigured")
         self.__struct[name] = value
+        if self._children:
+            self._children.pop(name, None)
         if isinstance(value, Configuration):
             value._parent = self
 
@@ -107,76 +224,120 @@ class Configuration(MutableMapping):
         if self.__struct is None:
             raise ConfigurationError("unconfigured")
         self.__struct.__delitem__(name)
+        if self._children:
+            self._children.pop(name, None)
 
     def __getattr__(self, name):
+        if name[:2] == '__':
+            raise AttributeError(name)
         return self[name]
 
     def _merge(self, config):
-        for k, v in config.items():
-            if isinstance(v, Mapping) and k in self:
-                if not isinstance(self[k], Mapping):
-                    raise ConfigurationError(
-                        "unresolveable conflict during merge")
-                self[k]._merge(v)
-            else:
-                self[k] = v
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        _merge_into(_unwrap(self.__struct), _unwrap(config))
 
     def by_ref(self, path, value=None):
-        if path[:2] == "..":
-            path = path[1:]
-            return self._parent.by_ref(path, value)
-
-        if path[:1] != ".":
-            return self._root.by_ref("." + path, value)
-
-        path = path[1:]
-        if "." in path:
-            n, path = path.split(".", 1)
-            n = self[n]
-            if isinstance(n, Configuration):
-                return n.by_ref("." + path, value)
-            else:
-                return obj_by_ref(n, path)
+        up, keys = _parse_ref(path)
+        node = _ref_base(self, up, path)
+        for i, key in enumerate(keys[:-1]):
+            node = node[key]
+            if not isinstance(node, Configuration):
+                return _get_attrs(node, keys[i + 1:])
+        if value is None:
+            return node[keys[-1]]
         else:
-            if value is None:
-                return self[path]
-            else:
-                self[path] = value
-                return value
+            node[keys[-1]] = value
+            return value
 
     def __add__(self, config):
         return self.merge(config)
 
-    def configure(self, struct=None, _root=True):
+    def configure(self, struct=None, _root=True, max_workers=None, lazy=False):
         """ Commit configuration
 
         This method performs all actions pending to this ``Configuration``
         object. You can also override configuration at this moment by providing
         mapping object as ``struct`` argument.
+
+        Files pulled in by ``!include:`` and ``!extends:`` are read and
+        parsed on a pool of ``max_workers`` threads when it is given.
+
+        With ``lazy`` set, other directives (and lists holding some) are left
+        pending and resolved the first time they are read, so the objects of
+        subtrees nobody reads are never imported or built. See
+        :meth:`resolve_all`.
         """
         if struct is not None:
             if isinstance(struct, self.__class__):
                 struct = struct._Configuration__struct
             self.__struct = struct
-
-        def _impl(v):
-            if isinstance(v, Directive):
-                return v(self)
-            if isinstance(v, Configuration):
-                return v.configure(_root=False)
-            if isinstance(v, list):
-                for x in v[:]:
-                    v[v.index(x)] = _impl(x)
-            return v
+            self._children = None
+            self._session = None
+            self._environment = None
+
+        session = None
+        if _root and self._session is None:
+            if self._environment is None:
+                self._environment = _Environment()
+            # every !include: and !extends: target is loaded once, up front
+            session = self._session = _Session(max_workers=max_workers, lazy=lazy, environment=self._environment)
+            if Configuration._tracer is None:
+                session.graph.resolve(self._source, self.__struct, self._pwd)
+            else:
+                _trace(Configuration._tracer, 'includes', self._source, None, self._source,
+                       session.graph.resolve, self._source, self.__struct, self._pwd)
+        lazy = self._root._session is not None and self._root._session.lazy
 
         if _root:
             if isinstance(self.__struct, Extends):
-                self.__struct = self.__struct(
-                    Configuration.from_dict({}, pwd=self._pwd))
+                ctx = Configuration({}, pwd=self._pwd)
+                ctx._session = self._session
+                self.__struct = self.__struct(ctx)
+
+        if Configuration._tracer is None or not _root:
+            _configure_tree(self, self.__struct, lazy)
+        else:
+            _trace(Configuration._tracer, 'configure', self._source, None, self._source,
+                   _configure_tree, self, self.__struct, lazy)
+
+        if session is not None:
+            session.graph.release()
+
+        return self
+
+    async def aconfigure(self, struct=None):
+        """ Coroutine version of :meth:`configure`
+
+        Included and extended files are read and parsed in the default
+        executor, independent ones concurrently, so the event loop is not
+        blocked while they load. Awaitables left in the tree (like the
+        result of a coroutine function used as ``!factory:``) are awaited
+        and replaced by their results; an awaitable passed as an argument
+        of another factory is passed as is.
+        """
+        if struct is not None:
+            if isinstance(struct, self.__class__):
+                struct = struct._Configuration__struct
+            self.__struct = struct
+            self._children = None
+            self._session = None
+            self._environment = None
+
+        session = None
+        if self._session is None:
+            if self._environment is None:
+                self._environment = _Environment()
+            session = self._session = _Session(environment=self._environment)
+            await session.graph.aresolve(self._source, self.__struct, self._pwd)
 
-        for k, v in self.items():
-            self[k] = _impl(v)
+        try:
+            self.configure()
+        finally:
+            if session is not None:
+                session.graph.release()
 
+        await _await_values(self.__struct)
         return self
 
     def __repr__(self):
@@ -186,53 +347,259 @@ class Configuration(MutableMapping):
 
     @classmethod
     def from_file(cls, filename, ctx=None, pwd=None, constructors=None,
-                  multi_constructors=None, implicit_resolvers=None, configure=True):
+                  multi_constructors=None, implicit_resolvers=None, configure=True,
+                  max_workers=None, lazy=False):
         """ Construct :class:`.Configuration` object by reading and parsing file
         ``filename``.
 
         :param filename:
             filename to parse config from
         :param ctx:
-            mapping object used for value interpolation
+            mapping interpolated into the strings of the parsed tree
+            with ``str.format`` syntax, see :meth:`render`
         :param constructors:
             mapping of names to constructor for custom objects in YAML. Look at
             `_timedelta_constructor` and `_re_constructor` for examples.
+        :param max_workers:
+            number of threads used to load included and extended files
+            concurrently, they are loaded one after another by default
+        :param lazy:
+            resolve directives on first access, see :meth:`configure`
         """
         filename = path.abspath(filename)
         if pwd is None:
             pwd = path.dirname(filename)
-        with open(filename, "r") as f:
-            return cls.from_string(f.read(), ctx=ctx, pwd=pwd,
-                                   constructors=constructors,
+        environment = _Environment()
+        cfg = cls._parse_file(filename, ctx=ctx, constructors=constructors,
+                              multi_constructors=multi_constructors,
+                              implicit_resolvers=implicit_resolvers, environment=environment)
+        c = cls(cfg, pwd=pwd)
+        c._source = filename
+        c._environment = environment
+        if configure:
+            c.configure(max_workers=max_workers, lazy=lazy)
+        return c
+
+    @classmethod
+    def iter_documents(cls, path_or_stream, ctx=None, pwd=None, constructors=None,
+                       multi_constructors=None, implicit_resolvers=None, configure=True,
+                       lazy=False):
+        """ Yield a :class:`.Configuration` for each document of a YAML
+        stream, one at a time.
+
+        :param path_or_stream:
+            filename or file-like object (a pipe for instance) to read the
+            documents from
+        :param ctx:
+            mapping interpolated into the strings of each document,
+            see :meth:`render`. Only the document being parsed is kept in
+            memory.
+
+        Other arguments are those of :meth:`from_file`.
+        """
+        loader = cls._loader_class(constructors=constructors,
                                    multi_constructors=multi_constructors,
-                                   implicit_resolvers=implicit_resolvers,
-                                   configure=configure)
+                                   implicit_resolvers=implicit_resolvers)
+        filename = opened = None
+        if isinstance(path_or_stream, (str, os.PathLike)):
+            filename = path.abspath(path_or_stream)
+            if pwd is None:
+                pwd = path.dirname(filename)
+            stream = opened = open(filename, "rb")
+        else:
+            stream = path_or_stream
+        try:
+            for struct, environment in _iter_loaded(loader, stream):
+                if ctx:
+                    struct = _interpolate(struct, ctx)
+                c = cls(struct, pwd=pwd)
+                c._source = filename
+                c._environment = environment
+                if configure:
+                    c.configure(lazy=lazy)
+                yield c
+        finally:
+            if opened is not None:
+                opened.close()
+
+    @classmethod
+    def _parse_file(cls, filename, ctx=None, constructors=None,
+                    multi_constructors=None, implicit_resolvers=None, environment=None):
+        """ Read and parse ``filename`` into a struct owned by the caller,
+        going through the parsed file cache when it is enabled, and
+        interpolate ``ctx`` into it.
+
+        Environment variables are read from the ``environment`` snapshot of
+        the load, cached entries are only used while the variables their
+        file read keep the same values.
+        """
+        loader = cls._loader_class(constructors=constructors,
+                                   multi_constructors=multi_constructors,
+                                   implicit_resolvers=implicit_resolvers)
+        if environment is None:
+            environment = _Environment()
+        scope = environment.scope()
+        cache = Configuration._file_cache
+        key = None
+        if cache is not None:
+            key = _file_cache_key(filename, loader)
+            cfg = cache.get(key, scope)
+            if cfg is not _missing:
+                environment.files[filename] = scope.used
+                return _interpolate(cfg, ctx) if ctx else cfg
+
+        tracer = Configuration._tracer
+        uncacheable = []
+        if tracer is None:
+            cfg = cls._read_file(filename, loader, None, scope, uncacheable)
+        else:
+            cfg = _trace(tracer, 'file', filename, None, filename, cls._read_file, filename, loader, tracer, scope,
+                         uncacheable)
+
+        environment.files[filename] = scope.used
+        if key is not None and not uncacheable:
+            cache.put(key, cfg, key[2], scope.used)
+            cfg = _copy_struct(cfg)
+        return _interpolate(cfg, ctx) if ctx else cfg
+
+    @classmethod
+    def _read_file(cls, filename, loader, tracer=None, environment=None, uncacheable=None):
+        """ Parse ``filename``, the tags that kept it out of the caches are
+        appended to ``uncacheable`` """
+        if uncacheable is None:
+            uncacheable = []
+        disk_cache = Configuration._disk_cache
+        if disk_cache is not None:
+            with open(filename, "rb") as f:
+                data = f.read()
+            cfg = disk_cache.load(filename, data, loader, environment)
+            if cfg is _missing:
+                cfg = _load_single(loader, data, tracer, filename, environment, uncacheable)
+                if not uncacheable:
+                    disk_cache.store(filename, data, loader, cfg, environment.used if environment else None)
+        else:
+            # the loader reads the file in chunks without decoding or
+            # copying it as a whole
+            with open(filename, "rb") as f:
+                cfg = _load_single(loader, f, tracer, filename, environment, uncacheable)
+        return cfg
+
+    @classmethod
+    def enable_file_cache(cls, max_entries=128, max_size=64 * 1024 * 1024):
+        """ Enable the process-wide cache of parsed files used by
+        ``from_file``, ``!include:`` and ``!extends:``.
+
+        Entries are keyed by absolute path, modification time, size and
+        loader, and evicted in LRU order once there are more than
+        ``max_entries`` of them or their source files add up to more than
+        ``max_size`` bytes. The interpolation context is applied to the copy
+        returned, so an entry serves every context. Values built by
+        constructors at parse time (``!envvar``, ``!logging``...) are cached
+        as well.
+
+        :return: the :class:`ParsedFileCache` in use
+        """
+        Configuration._file_cache = ParsedFileCache(max_entries=max_entries, max_size=max_size)
+        return Configuration._file_cache
+
+    @classmethod
+    def disable_file_cache(cls):
+        """ Disable and drop the process-wide parsed files cache """
+        Configuration._file_cache = None
+
+    @classmethod
+    def enable_disk_cache(cls, directory):
+        """ Enable the process-wide on-disk cache of parsed files stored in
+        ``directory``.
+
+        After a file is parsed once its struct (directives included) is
+        pickled there, so later processes skip YAML parsing as long as the
+        content hash of the file is unchanged. Included and extended files
+        have entries of their own, checked when their directive runs. Only
+        point this to a directory nobody else can write to.
+
+        :return: the :class:`CompiledFileCache` in use
+        """
+        Configuration._disk_cache = CompiledFileCache(directory)
+        return Configuration._disk_cache
+
+    @classmethod
+    def disable_disk_cache(cls):
+        """ Stop using the on-disk cache of parsed files """
+        Configuration._disk_cache = None
+
+    @classmethod
+    def enable_tracing(cls, tracer=None):
+        """ Send the phases of loading and configuring to ``tracer``, a
+        :class:`Tracer` (a new :class:`SlowestTracer` by default).
+
+        Tracing is process-wide. When it is disabled the code paths are
+        the untraced ones.
+
+        :return: the tracer in use
+        """
+        Configuration._tracer = tracer if tracer is not None else SlowestTracer()
+        return Configuration._tracer
+
+    @classmethod
+    def disable_tracing(cls):
+        """ Stop tracing """
+        Configuration._tracer = None
+
+    @classmethod
+    async def afrom_file(cls, filename, ctx=None, pwd=None, constructors=None,
+                         multi_constructors=None, implicit_resolvers=None, configure=True):
+        """ Coroutine version of :meth:`from_file`, reading and parsing in
+        the default executor and configuring with :meth:`aconfigure`. """
+        c = await get_running_loop().run_in_executor(None, partial(
+            cls.from_file, filename, ctx=ctx, pwd=pwd, constructors=constructors,
+            multi_constructors=multi_constructors, implicit_resolvers=implicit_resolvers,
+            configure=False))
+        if configure:
+            await c.aconfigure()
+        return c
+
+    @classmethod
+    async def afrom_string(cls, string, ctx=None, pwd=None, constructors=None,
+                           multi_constructors=None, implicit_resolvers=None, configure=True):
+        """ Coroutine version of :meth:`from_string`, parsing in the default
+        executor and configuring with :meth:`aconfigure`. """
+        c = await get_running_loop().run_in_executor(None, partial(
+            cls.from_string, string, ctx=ctx, pwd=pwd, constructors=constructors,
+            multi_constructors=multi_constructors, implicit_resolvers=implicit_resolvers,
+            configure=False))
+        if configure:
+            await c.aconfigure()
+        return c
 
     @classmethod
     def from_string(cls, string, ctx=None, pwd=None, constructors=None,
-                    multi_constructors=None, implicit_resolvers=None, configure=True):
+                    multi_constructors=None, implicit_resolvers=None, configure=True, lazy=False):
         """ Construct :class:`.Configuration` from ``string``.
 
         :param string:
             string to parse config from
         :param ctx:
-            mapping object used for value interpolation
+            mapping interpolated into the strings of the parsed tree
+            with ``str.format`` syntax, see :meth:`render`
         :param constructors:
             mapping of names to constructor for custom objects in YAML. Look at
             `_timedelta_constructor` and `_re_constructor` for examples.
         """
-        ctx = ctx or {}
-        # ctx['pwd'] = pwd
-        # string = string % ctx
-        if ctx:
-            string = string.format(**ctx)
+        environment = _Environment()
         cfg = cls.load(string, constructors=constructors,
                        multi_constructors=multi_constructors,
-                       implicit_resolvers=implicit_resolvers)
-        return cls.from_dict(cfg, pwd=pwd, configure=configure)
+                       implicit_resolvers=implicit_resolvers, _environment=environment)
+        if ctx:
+            cfg = _interpolate(cfg, ctx)
+        c = cls(cfg, pwd=pwd)
+        c._environment = environment
+        if configure:
+            c.configure(lazy=lazy)
+        return c
 
     @classmethod
-    def from_dict(cls, cfg, pwd=None, configure=True):
+    def from_dict(cls, cfg, pwd=None, configure=True, lazy=False):
         """ Construct :class:`.Configuration` from dict ``d``.
 
         :param d:
@@ -240,24 +607,164 @@ class Configuration(MutableMapping):
         """
         c = cls(cfg, pwd=pwd)
         if configure:
-            c.configure()
+            c.configure(lazy=lazy)
         return c
 
-    def to_dict(self):
-        """Converts Configuration object attributes to a dictionary."""
-        converted = dict(self)
-        # We check the dict recursively
-        for k, v in converted.items():
-            if isinstance(v, self.__class__):
-                converted[k] = v.to_dict()
+    def resolve_all(self):
+        """ Resolve every value a lazy :meth:`configure` left pending, for
+        instance to validate the whole configuration """
+        stack = [self]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, Configuration):
+                stack.extend(value[k] for k in list(value))
+            elif isinstance(value, list):
+                stack.extend(value)
+        return self
+
+    def to_dict(self, copy=True):
+        """Converts Configuration object attributes to a dictionary.
+
+        Mappings and lists are converted at any depth, nested
+        configurations become dicts.
+
+        :param copy:
+            with ``False`` the underlying containers are returned whenever
+            they hold no configuration, only the ones on the way to one are
+            copied. Cheap (for ``json.dumps`` for instance) but the result
+            shares this tree and must not be modified.
+        """
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        _resolve_pending(self)
+        return _export(self, copy)
+
+    def dump(self, stream, format='yaml', directives=False):
+        """ Write the configuration to the text stream ``stream``
+
+        :param format:
+            ``'yaml'`` (written by the libyaml safe dumper when available) or
+            ``'json'``
+        :param directives:
+            write the directives that are still pending, in trees loaded
+            with ``configure=False`` or not read yet in lazy ones, as their
+            original tags so the output loads back to the same tree. YAML
+            only, resolved directives are written as their values.
+        """
+        if not directives:
+            data = self.to_dict(copy=False)
+        elif self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        else:
+            data = _export(self, False)
+        _dump(data, stream, format, directives)
+
+    def render(self, ctx, configure=True, lazy=False):
+        """ Return a new configuration with ``ctx`` interpolated into the
+        strings of this one.
+
+        Strings of the YAML text holding braces, mapping keys included, are
+        ``str.format`` templates: ``"{name}"`` is replaced by ``ctx["name"]``
+        and ``"{{"`` stands for a brace. Strings built by constructors
+        (``ENV:`` values, ``!concat``...) or set after loading are left as
+        they are. Mappings, lists and the arguments of pending directives
+        are walked and each template is compiled once per process, so a tree
+        loaded once with ``configure=False`` can be rendered for many
+        contexts without parsing it again.
+
+        :param configure:
+            configure the new configuration, ``lazy`` as in :meth:`configure`
+        """
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        root = self._root
+        c = self.__class__(_interpolate(_copy_struct(self.__struct), ctx), pwd=self._pwd)
+        c._source = root._source
+        c._environment = root._environment
+        if configure:
+            c.configure(lazy=lazy)
+        return c
 
-        return converted
+    def diff(self, other):
+        """ Return the :class:`ConfigurationDiff` turning this configuration
+        into ``other``
+
+        Mappings are walked down to their values and skipped when they are
+        the same object, other values are compared by identity first and by
+        equality then.
+        """
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        _resolve_pending(self)
+        return _diff(self.__struct, _unwrap(_resolve_pending(other)))
+
+    def apply_patch(self, changes):
+        """ Return a new configuration made of this one with ``changes`` (a
+        :class:`ConfigurationDiff`) applied
+
+        Only mappings on the path to a change are copied, every other
+        subtree is shared with this configuration.
+        """
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        # the new configuration has no session to resolve pending values
+        _resolve_pending(self)
+        root = dict(self.__struct)
+        copied = {(): root}
+
+        def container(parts):
+            node = root
+            for i in range(len(parts)):
+                key = parts[:i + 1]
+                try:
+                    node = copied[key]
+                except KeyError:
+                    child = _unwrap(node.get(parts[i]))
+                    if not isinstance(child, dict):
+                        raise ConfigurationError("cannot apply patch at %r" % (key,))
+                    node[parts[i]] = node = copied[key] = dict(child)
+            return node
+
+        for parts in changes.removed:
+            del container(parts[:-1])[parts[-1]]
+        for parts, (_, value) in changes.changed.items():
+            container(parts[:-1])[parts[-1]] = value
+        for parts, value in changes.added.items():
+            container(parts[:-1])[parts[-1]] = value
+
+        return self.__class__(root, pwd=self._pwd)
+
+    def freeze(self):
+        """ Compile this configuration into an immutable
+        :class:`FrozenConfiguration` snapshot.
+
+        Every mapping node becomes an instance of a generated ``__slots__``
+        class, so reading ``snapshot.db.host`` is a plain slot lookup. Lists
+        are frozen into tuples.
+        """
+        if self.__struct is None:
+            raise ConfigurationError("unconfigured")
+        _resolve_pending(self)
+        return _freeze_mapping(self.__struct, None, self._pwd)
 
     @classmethod
     def load(cls, stream, constructors=None, multi_constructors=None,
-             implicit_resolvers=None):
-        loader = Loader(stream)
+             implicit_resolvers=None, _environment=None):
+        loader = cls._loader_class(constructors=constructors,
+                                   multi_constructors=multi_constructors,
+                                   implicit_resolvers=implicit_resolvers)
+        return _load_single(loader, stream, environment=_environment)
 
+    @classmethod
+    def _loader_class(cls, constructors=None, multi_constructors=None,
+                      implicit_resolvers=None):
+        """ Return a ``Loader`` subclass with every constructor and implicit
+        resolver of ``cls`` plus the given overrides registered on it.
+
+        Subclasses are cached (LRU, ``_loader_cache_size`` entries) by the
+        registries they were built from, so a repeated load only pays for
+        parsing and never touches the shared base ``Loader`` class.
+        """
         cs = dict(cls._constructors)
         if constructors:
             cs.update(constructors)
@@ -270,25 +777,40 @@ class Configuration(MutableMapping):
         if multi_constructors:
             mcs.update(multi_constructors)
 
-        if cs:
-            for name, constructor in cs.items():
-                loader.add_constructor(name, constructor)
+        traced = Configuration._tracer is not None
+        key = (tuple(cs.items()), tuple(mcs.items()), tuple(ir.items()), traced)
+        try:
+            hash(key)
+        except TypeError:
+            return _build_loader_class(cs, mcs, ir, traced)
 
-        if mcs:
-            for name, constructor in mcs.items():
-                loader.add_multi_constructor(name, constructor)
+        with _loader_cache_lock:
+            try:
+                loader = _loader_cache[key]
+            except KeyError:
+                pass
+            else:
+                _loader_cache.move_to_end(key)
+                return loader
 
-        if ir:
-            for name, pattern in ir.items():
-                loader.add_implicit_resolver(name, pattern, None)
+        loader = _build_loader_class(cs, mcs, ir, traced)
 
-        try:
-            return loader.get_single_data()
-        finally:
-            loader.dispose()
+        with _loader_cache_lock:
+            loader = _loader_cache.setdefault(key, loader)
+            while len(_loader_cache) > cls._loader_cache_size:
+                _loader_cache.popitem(last=False)
+        return loader
 
     @classmethod
-    def add_constructor(cls, name):
+    def add_constructor(cls, name, cacheable=False):
+        """ Register the decorated function as constructor of ``!name``
+
+        :param cacheable:
+            whether its values only depend on the YAML node (and on
+            environment variables read through :func:`get_envvar` style
+            specs), so files using it can be kept by the parsed file caches.
+            Files using other constructors are parsed on every load.
+        """
         if '_constructors' not in cls.__dict__:
             cls.__dict__['_constructors'] = dict(cls._constructors)
         cname = '!%s' % name
@@ -297,6 +819,8 @@ class Configuration(MutableMapping):
             if cname in cls._constructors:
                 raise ValueError("constructor '%s' already exist")
             cls._constructors[cname] = func
+            if cacheable:
+                _cacheable_constructors.add(func)
             return func
 
         return registration
@@ -310,7 +834,9 @@ class Configuration(MutableMapping):
         cls._implicit_resolvers[cname] = pattern
 
     @classmethod
-    def add_multi_constructor(cls, name):
+    def add_multi_constructor(cls, name, cacheable=False):
+        """ Register the decorated function as constructor of ``!name:...``
+        tags, ``cacheable`` as in :meth:`add_constructor` """
         if '_multi_constructors' not in cls.__dict__:
             cls.__dict__['_multi_constructors'] = dict(cls._multi_constructors)
         cname = '!%s:' % name
@@ -319,12 +845,1004 @@ class Configuration(MutableMapping):
             if cname in cls._multi_constructors:
                 raise ValueError("multiconstructor '%s' already exist")
             cls._multi_constructors[cname] = func
+            if cacheable:
+                _cacheable_constructors.add(func)
             return func
 
         return registration
 
 
-@Configuration.add_constructor('timedelta')
+def _qualified_name(obj):
+    return "%s.%s" % (getattr(obj, '__module__', None), getattr(obj, '__qualname__', repr(obj)))
+
+
+def _resolve_pending(value):
+    """ Resolve the values a lazy :meth:`Configuration.configure` left
+    pending when ``value`` is such a configuration, return ``value`` """
+    if isinstance(value, Configuration):
+        session = value._root._session
+        if session is not None and session.lazy:
+            value.resolve_all()
+    return value
+
+
+class ConfigurationDiff(object):
+    """ Changes between two configurations, see :meth:`Configuration.diff`
+
+    ``added`` and ``removed`` map paths, tuples of the keys from the root,
+    to values, ``changed`` maps them to ``(old, new)`` pairs. Mappings are
+    reported as plain dicts.
+    """
+
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or {}
+        self.removed = removed or {}
+        self.changed = changed or {}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __repr__(self):
+        return '%s(added=%r, removed=%r, changed=%r)' % (
+            self.__class__.__name__, self.added, self.removed, self.changed)
+
+
+def _export(value, copy):
+    """ Convert ``value`` and everything below it to plain dicts and lists,
+    see :meth:`Configuration.to_dict` """
+    return _export_copy(value) if copy else _export_shared(value)
+
+
+class _Template(str):
+    """ String of the YAML text holding braces, the ones :meth:`render`
+    interpolates into """
+
+    __slots__ = ()
+
+
+def _construct_str(loader, node):
+    value = loader.construct_scalar(node)
+    if '{' in value or '}' in value:
+        return _Template(value)
+    return value
+
+
+# types of values that are never containers, checked first since isinstance()
+# against Configuration (an ABC) is slow
+_SCALARS = frozenset((str, _Template, int, float, bool, bytes, type(None)))
+
+
+def _export_copy(value):
+    """ Copy every container of ``value`` in a single pass, a container found
+    several times is copied each time (no map of the copies is kept, only
+    the containers on the way to the current one to report cycles) """
+    root = _unwrap(value)
+    if not isinstance(root, (dict, list)):
+        return root
+    new = {} if isinstance(root, dict) else []
+    path = {}
+    stack = [(root, new, 0)]
+    while stack:
+        src, dst, depth = stack.pop()
+        _descend(path, src, depth)
+        if dst.__class__ is dict:
+            dst.update(src)
+            items = src.items()
+        else:
+            dst.extend(src)
+            items = enumerate(src)
+        for k, v in items:
+            cls = v.__class__
+            if cls in _SCALARS:
+                continue
+            if cls is not dict and cls is not list:
+                if not isinstance(v, (dict, list, Configuration)):
+                    continue
+                v = _unwrap(v)
+                if not isinstance(v, (dict, list)):
+                    dst[k] = v
+                    continue
+            if id(v) in path:
+                raise ConfigurationError("cannot convert a cyclic configuration")
+            copy = dst[k] = {} if isinstance(v, dict) else []
+            stack.append((v, copy, depth + 1))
+    return new
+
+
+def _descend(path, container, depth):
+    """ Make ``container``, found at ``depth`` by a depth-first walk, the last
+    one of ``path``: the ids of the containers from the root to it, in an
+    ordered dict so the walk going back up only pops its end """
+    while len(path) > depth:
+        path.popitem()
+    path[id(container)] = None
+
+
+def _export_shared(value):
+    """ Return the containers of ``value``, only copying the ones on the way
+    to a nested configuration """
+    root = _unwrap(value)
+    if not isinstance(root, (dict, list)):
+        return root
+    # containers as (container, index of the parent, key in the parent)
+    entries = [(root, -1, None)]
+    seen = {id(root)}
+    found = []
+    # entries grows while it is iterated, which visits them breadth first
+    for i, (container, _, _) in enumerate(entries):
+        for k, v in (container.items() if isinstance(container, dict) else enumerate(container)):
+            cls = v.__class__
+            if cls in _SCALARS:
+                continue
+            if cls is dict or cls is list or isinstance(v, (dict, list)):
+                key = id(v)
+                if key not in seen:
+                    seen.add(key)
+                    entries.append((v, i, k))
+            elif isinstance(v, Configuration):
+                found.append((i, k, v))
+    if not found:
+        return root
+
+    copies = {}
+
+    def copied(i):
+        path = []
+        while i not in copies and i >= 0:
+            path.append(i)
+            i = entries[i][1]
+        for i in reversed(path):
+            container, parent, key = entries[i]
+            copies[i] = dict(container) if isinstance(container, dict) else list(container)
+            if parent >= 0:
+                copies[parent][key] = copies[i]
+        return copies[i]
+
+    for i, k, v in found:
+        copied(i)[k] = _export_shared(v)
+    return copies[0]
+
+
+def _unwrap(value):
+    while isinstance(value, Configuration):
+        if isinstance(value, OverlayConfiguration):
+            return value._materialize()
+        value = value._Configuration__struct
+    return value
+
+
+class _Layers(list):
+    """ Mappings merged into a single key by :func:`_merge_structs` """
+
+    __slots__ = ()
+
+
+def _merge_structs(structs):
+    """ Deep merge mappings (later ones win) into a new tree in one pass
+
+    Every merged mapping is a new dict, other values are shared with the
+    layers. A mapping can only be merged over another mapping.
+    """
+    result = {}
+    stack = [(result, structs)]
+    while stack:
+        target, layers = stack.pop()
+        merged = {}
+        for layer in layers:
+            for k, v in layer.items():
+                v = _unwrap(v)
+                if isinstance(v, Mapping):
+                    current = merged.get(k, _missing)
+                    if current is _missing:
+                        merged[k] = _Layers((v,))
+                    elif current.__class__ is _Layers:
+                        current.append(v)
+                    else:
+                        raise ConfigurationError("unresolveable conflict during merge")
+                else:
+                    merged[k] = v
+        for k, v in merged.items():
+            if v.__class__ is _Layers:
+                child = target[k] = {}
+                stack.append((child, v))
+            else:
+                target[k] = v
+    return result
+
+
+def _merge_into(target, source):
+    """ Deep merge mapping ``source`` into ``target`` in place """
+    stack = [(target, source)]
+    while stack:
+        target, source = stack.pop()
+        for k, v in source.items():
+            v = _unwrap(v)
+            if isinstance(v, Mapping) and k in target:
+                current = _unwrap(target[k])
+                if not isinstance(current, Mapping):
+                    raise ConfigurationError("unresolveable conflict during merge")
+                stack.append((current, v))
+            else:
+                target[k] = v
+
+
+def _diff(old, new):
+    changes = ConfigurationDiff()
+    stack = [((), old, new)]
+    while stack:
+        prefix, old, new = stack.pop()
+        for k, v in old.items():
+            if k not in new:
+                changes.removed[prefix + (k,)] = _unwrap(v)
+                continue
+            w = new[k]
+            if v is w:
+                continue
+            v, w = _unwrap(v), _unwrap(w)
+            if isinstance(v, dict) and isinstance(w, dict):
+                # nested mappings are walked rather than compared as a
+                # whole, so each value is only compared once
+                if v is not w:
+                    stack.append((prefix + (k,), v, w))
+            elif not _same(v, w):
+                changes.changed[prefix + (k,)] = (v, w)
+        for k, w in new.items():
+            if k not in old:
+                changes.added[prefix + (k,)] = _unwrap(w)
+    return changes
+
+
+_loader_cache = OrderedDict()
+_loader_cache_lock = Lock()
+
+
+def _build_loader_class(constructors, multi_constructors, implicit_resolvers, traced=False):
+    loader = type('ConfigurationLoader', (Loader,), {})
+    # stable description of the registries, used to name on-disk cache entries
+    loader.fingerprint = repr((
+        sorted((n, _qualified_name(c)) for n, c in constructors.items()),
+        sorted((n, _qualified_name(c)) for n, c in multi_constructors.items()),
+        [(n, getattr(p, 'pattern', p)) for n, p in implicit_resolvers.items()]))
+
+    # marks the strings render() interpolates into
+    loader.add_constructor('tag:yaml.org,2002:str', _construct_str)
+    for name, constructor in constructors.items():
+        constructor = _cache_checked_constructor(name, constructor)
+        loader.add_constructor(name, _traced_constructor(name, constructor) if traced else constructor)
+
+    for name, constructor in multi_constructors.items():
+        constructor = _cache_checked_constructor(name, constructor)
+        loader.add_multi_constructor(name, _traced_constructor(name, constructor) if traced else constructor)
+
+    for name, pattern in implicit_resolvers.items():
+        loader.add_implicit_resolver(name, pattern, None)
+
+    return loader
+
+
+# constructors registered with cacheable=True
+_cacheable_constructors = set()
+
+
+def _cache_checked_constructor(name, constructor):
+    """ Wrap ``constructor`` unless it is cacheable, so the files it is used
+    in are kept out of the parsed file caches: its values may depend on
+    imported code or it may have side effects (``!logging``) """
+    if constructor in _cacheable_constructors:
+        return constructor
+
+    def checked(loader, *args):
+        _uncacheable(loader, name + args[0] if len(args) > 1 else name)
+        return constructor(loader, *args)
+
+    return checked
+
+
+def _uncacheable(loader, tag):
+    uncacheable = getattr(loader, 'uncacheable', None)
+    if uncacheable is not None:
+        uncacheable.append(tag)
+
+
+def _traced_constructor(name, constructor):
+    """ Wrap ``constructor`` to trace its calls, only loader classes built
+    while tracing is enabled use it """
+
+    def traced(loader, *args):
+        tracer = Configuration._tracer
+        if tracer is None:
+            return constructor(loader, *args)
+        tag = name + args[0] if len(args) > 1 else name
+        return _trace(tracer, 'constructor', tag, None, None, constructor, loader, *args)
+
+    return traced
+
+
+def _load_single(loader, stream, tracer=None, source=None, environment=None, uncacheable=None):
+    """ Parse the single document of ``stream``, tags of constructors whose
+    values cannot be cached are appended to ``uncacheable`` """
+    loader = loader(stream)
+    # read by the constructors of environment variables
+    loader.environment = environment
+    loader.uncacheable = uncacheable
+    try:
+        if tracer is None:
+            return loader.get_single_data()
+        return _trace(tracer, 'parse', source, None, source, loader.get_single_data)
+    finally:
+        loader.dispose()
+
+
+def _iter_loaded(loader, stream):
+    """ Yield the struct of each document of ``stream`` with the
+    :class:`_Environment` it was loaded with """
+    loader = loader(stream)
+    try:
+        while loader.check_data():
+            environment = loader.environment = _Environment()
+            yield loader.get_data(), environment
+    finally:
+        loader.dispose()
+
+
+_missing = object()
+
+
+class ParsedFileCache(object):
+    """ LRU cache of parsed (not yet configured) YAML files
+
+    Enabled through :meth:`Configuration.enable_file_cache`. Every read
+    returns a fresh copy of the cached struct, so configuring it can never
+    corrupt the cache.
+    """
+
+    def __init__(self, max_entries=128, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, environment=None):
+        """ Return a copy of the struct cached under ``key``, when the
+        environment variables it was parsed with have the same values in
+        ``environment`` (an :class:`_Environment`) """
+        with self._lock:
+            try:
+                struct, size, used = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return _missing
+            if used and not (environment or _Environment()).matches(used):
+                self.misses += 1
+                return _missing
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return _copy_struct(struct)
+
+    def put(self, key, struct, size, used=None):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (struct, size, used)
+            self._size += size
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_size):
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """ Return hits, misses, evictions, entries and size (bytes of
+        source files) of this cache """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self._size,
+            }
+
+
+def _file_cache_key(filename, loader):
+    st = os.stat(filename)
+    return filename, st.st_mtime_ns, st.st_size, loader
+
+
+class CompiledFileCache(object):
+    """ On-disk cache of parsed (not yet configured) YAML files
+
+    Enabled through :meth:`Configuration.enable_disk_cache`. An entry is
+    named after the file path and loader registry
+    and starts with a versioned header holding the content hash of the
+    source file and the environment variables read while parsing it,
+    followed by the pickled struct.
+    """
+
+    MAGIC = b"configure-compiled\n"
+    FORMAT = 5
+
+    def __init__(self, directory):
+        self.directory = path.abspath(directory)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entry(self, filename, loader):
+        key = repr((filename, loader.fingerprint))
+        return path.join(self.directory, blake2b(key.encode(), digest_size=20).hexdigest())
+
+    def load(self, filename, data, loader, environment=None):
+        """ Return the struct cached for ``filename`` if ``data`` (its
+        current content) is what it was built from and the environment
+        variables it read have the same values in ``environment`` """
+        try:
+            with open(self._entry(filename, loader), "rb") as f:
+                if f.read(len(self.MAGIC)) == self.MAGIC:
+                    header = pickle.load(f)
+                    if (header[:3] == (self.FORMAT, __version__, blake2b(data).digest())
+                            and (environment or _Environment()).matches(header[3])):
+                        struct = pickle.load(f)
+                        self.hits += 1
+                        return struct
+        except Exception:
+            # missing, truncated or otherwise unusable entry
+            pass
+        self.misses += 1
+        return _missing
+
+    def store(self, filename, data, loader, struct, used=None):
+        """ Store ``struct`` parsed from ``data`` for ``filename`` with the
+        environment variables it ``used``, values that cannot be pickled
+        leave the file uncached """
+        entry = self._entry(filename, loader)
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC)
+                pickle.dump((self.FORMAT, __version__, blake2b(data).digest(), used or {}), f,
+                            pickle.HIGHEST_PROTOCOL)
+                pickle.dump(struct, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry)
+        except (OSError, pickle.PicklingError, TypeError, AttributeError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+def _copy_struct(value, memo=None):
+    """ Copy dicts, lists and directives of a parsed struct, other values
+    are shared
+
+    Containers are walked with an explicit stack, so deep structs (long
+    include chains) do not hit the recursion limit. """
+    if memo is None:
+        memo = {}
+    try:
+        return memo[id(value)]
+    except KeyError:
+        pass
+    if isinstance(value, Directive):
+        new = memo[id(value)] = deepcopy(value, memo)
+        return new
+    if not isinstance(value, (dict, list)):
+        return value
+    new = memo[id(value)] = {} if isinstance(value, dict) else []
+    stack = [(value, new)]
+    while stack:
+        src, dst = stack.pop()
+        if dst.__class__ is dict:
+            dst.update(src)
+            items = src.items()
+        else:
+            dst.extend(src)
+            items = enumerate(src)
+        for k, v in items:
+            if v.__class__ in _SCALARS:
+                continue
+            copy = memo.get(id(v), _missing)
+            if copy is _missing:
+                if isinstance(v, (dict, list)):
+                    copy = memo[id(v)] = {} if isinstance(v, dict) else []
+                    stack.append((v, copy))
+                elif isinstance(v, Directive):
+                    copy = memo[id(v)] = deepcopy(v, memo)
+                else:
+                    continue
+            dst[k] = copy
+    return new
+
+
+_formatter = Formatter()
+
+
+@lru_cache(maxsize=4096)
+def _compile_template(template):
+    """ Split the ``str.format`` template ``template`` once into a tuple of
+    ``(literal, field)`` parts, the literal text before each replacement
+    field and the field: its name when it is a plain key, a ``(name,
+    conversion, spec)`` tuple otherwise and ``None`` after the last one.
+    A template without replacement field (``{{`` and ``}}`` escapes only)
+    compiles to the resulting string. """
+    parts = []
+    try:
+        for literal, name, spec, conversion in _formatter.parse(template):
+            if name is None:
+                field = None
+            elif conversion is None and not spec and name and '.' not in name and '[' not in name \
+                    and not name.isdigit():
+                field = name
+            else:
+                # fields in the spec (``{value:{width}}``) are compiled too
+                field = (name, conversion, _compile_template(spec) if '{' in spec else spec)
+            parts.append((literal, field))
+    except ValueError as e:
+        raise ConfigurationError("cannot interpolate '%s': %s" % (template, e))
+    if all(field is None for _, field in parts):
+        return ''.join(literal for literal, _ in parts)
+    return tuple(parts)
+
+
+def _render_parts(parts, ctx):
+    out = []
+    for literal, field in parts:
+        out.append(literal)
+        if field.__class__ is str:
+            out.append(format(ctx[field]))
+        elif field is not None:
+            name, conversion, spec = field
+            value = _formatter.get_field(name, (), ctx)[0]
+            if conversion is not None:
+                value = _formatter.convert_field(value, conversion)
+            if spec.__class__ is not str:
+                spec = _render_parts(spec, ctx)
+            out.append(format(value, spec))
+    return ''.join(out)
+
+
+def _interpolate(struct, ctx):
+    """ Interpolate ``ctx`` into the templates of ``struct`` (keys too) in
+    place and return it, see :meth:`Configuration.render` """
+    stack = [struct]
+    seen = set()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            items = value.items()
+            if any(k.__class__ is _Template for k in value):
+                # keys are rendered in a new mapping keeping their order,
+                # then put back
+                rendered = {_render(k, ctx) if k.__class__ is _Template else k: v for k, v in items}
+                value.clear()
+                value.update(rendered)
+        elif isinstance(value, list):
+            items = enumerate(value)
+        elif isinstance(value, (Factory, Extends)):
+            stack.append(value.config)
+            continue
+        elif isinstance(value, Directory):
+            value._path = _render(value._path, ctx)
+            continue
+        else:
+            continue
+        for k, v in items:
+            cls = v.__class__
+            if cls is _Template:
+                value[k] = _render(v, ctx)
+            elif cls not in _SCALARS and id(v) not in seen:
+                seen.add(id(v))
+                stack.append(v)
+    return struct
+
+
+def _render(template, ctx):
+    compiled = _compile_template(template)
+    if compiled.__class__ is str:
+        return compiled
+    try:
+        return _render_parts(compiled, ctx)
+    except (KeyError, IndexError, AttributeError, ValueError) as e:
+        raise ConfigurationError("cannot interpolate '%s': %r" % (template, e))
+
+
+class OverlayConfiguration(Configuration):
+    """ Configuration made of a base configuration, read-only and shared,
+    and the paths overridden on top of it
+
+    Reads fall through to the base, writes only ever touch the overrides:
+    the mappings on the way to a written path are created in them then.
+    Memory used by an overlay grows with its overrides, not with its base.
+    Mappings of the overrides are merged over the mappings of the base,
+    other values (and mappings set with ``overlay[key] = value``) hide the
+    base value. Deleted keys leave a tombstone hiding the base value.
+
+    Build them with :meth:`Configuration.overlay`.
+    """
+
+    __slots__ = ('_base', '_name', '_base_config')
+
+    def __init__(self, base, changes=None, pwd=None, parent=None, _name=None):
+        # base configuration of a root overlay, values a lazy configure left
+        # pending in the base are resolved through it
+        self._base_config = base if isinstance(base, Configuration) else None
+        if isinstance(base, Configuration):
+            pwd = pwd or base._pwd
+            base = _unwrap(base)
+        if parent is None:
+            changes = _merge_structs([_unwrap(changes)]) if changes is not None else {}
+        Configuration.__init__(self, changes, pwd=pwd, parent=parent)
+        # base mapping at this level, None when it has none
+        self._base = base
+        # key in the parent overlay
+        self._name = _name
+
+    def __iter__(self):
+        own = self._Configuration__struct
+        base = self._base
+        if own is None:
+            return iter(base or ())
+        keys = [k for k in base if own.get(k, _missing) is not _deleted] if base else []
+        keys.extend(k for k, v in own.items() if v is not _deleted and (not base or k not in base))
+        return iter(keys)
+
+    def __contains__(self, name):
+        own = self._Configuration__struct
+        if own is not None and name in own:
+            return own[name] is not _deleted
+        return self._base is not None and name in self._base
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __getitem__(self, name):
+        own = self._Configuration__struct
+        value = own.get(name, _missing) if own is not None else _missing
+        base = _unwrap(self._base.get(name, _missing)) if self._base is not None else _missing
+        if base.__class__ is _Thunk:
+            base = self._force_base(name, base)
+        if value is _missing:
+            if base is _missing:
+                raise KeyError(name)
+            if isinstance(base, dict):
+                return self._overlay_child(name, None, base)
+            return base
+        if value is _deleted:
+            raise KeyError(name)
+        if isinstance(value, dict):
+            if value.__class__ is _Replaced or not isinstance(base, dict):
+                base = None
+            return self._overlay_child(name, value, base)
+        return value
+
+    def _child(self, name, data):
+        base = _unwrap(self._base.get(name)) if self._base is not None else None
+        if base.__class__ is _Thunk:
+            base = self._force_base(name, base)
+        return self._overlay_child(name, data, base if isinstance(base, dict) else None)
+
+    def _base_view(self):
+        """ Return the view of the base configuration at this level, ``None``
+        when the base is not a configuration """
+        names = []
+        node = self
+        while node._parent is not None:
+            names.append(node._name)
+            node = node._parent
+        view = node._base_config
+        if view is None:
+            return None
+        for name in reversed(names):
+            view = view[name]
+        return view
+
+    def _force_base(self, name, thunk):
+        """ Resolve the value a lazy configure left pending at ``name`` in
+        the base, storing it there """
+        view = self._base_view()
+        if view is None:
+            return thunk
+        return _unwrap(view[name])
+
+    def _overlay_child(self, name, own, base):
+        children = self._children
+        if children is None:
+            children = self._children = {}
+        else:
+            child = children.get(name)
+            if child is not None and child._Configuration__struct is own and child._base is base:
+                return child
+        child = children[name] = OverlayConfiguration(base, pwd=self._pwd, parent=self, _name=name)
+        child._Configuration__struct = own
+        return child
+
+    def _own(self):
+        """ Return the overrides of this level, creating the missing ones
+        up to the root """
+        own = self._Configuration__struct
+        if own is None:
+            parent = self._parent._own()
+            own = parent.get(self._name)
+            if not isinstance(own, dict):
+                own = parent[self._name] = {}
+            self._Configuration__struct = own
+        return own
+
+    def __setitem__(self, name, value):
+        own = self._own()
+        if isinstance(value, dict) and not isinstance(value, _Replaced):
+            value = _Replaced(value)
+        own[name] = value
+        if self._children:
+            self._children.pop(name, None)
+        if isinstance(value, Configuration):
+            value._parent = self
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        own = self._own()
+        if self._base is not None and name in self._base:
+            own[name] = _deleted
+        else:
+            del own[name]
+        if self._children:
+            self._children.pop(name, None)
+
+    def _merge(self, config):
+        for k, v in _unwrap(config).items():
+            current = self.get(k)
+            if isinstance(v, Mapping) and isinstance(current, Mapping):
+                current._merge(v)
+            elif isinstance(v, Mapping) and k in self:
+                raise ConfigurationError("unresolveable conflict during merge")
+            else:
+                self[k] = v
+
+    def _materialize(self):
+        if self._base is not None:
+            _resolve_pending(self._base_view())
+        return _overlay_struct(self._Configuration__struct, self._base)
+
+    def materialize(self):
+        """ Return a plain :class:`Configuration` with the overrides
+        applied, subtrees without overrides are shared with the base """
+        return Configuration(self._materialize(), pwd=self._pwd)
+
+    def diff(self, other):
+        return self.materialize().diff(other)
+
+    def apply_patch(self, changes):
+        return self.materialize().apply_patch(changes)
+
+    def freeze(self):
+        return self.materialize().freeze()
+
+    def to_dict(self, copy=True):
+        return _export(self._materialize(), copy)
+
+
+class _Replaced(dict):
+    """ Mapping set on an overlay, hiding the base mapping instead of being
+    merged over it """
+
+    __slots__ = ()
+
+
+_deleted = object()
+
+
+def _overlay_struct(own, base):
+    if own is None:
+        return base
+    struct = dict(base) if base is not None else {}
+    for k, v in own.items():
+        if v is _deleted:
+            struct.pop(k, None)
+        elif v.__class__ is _Replaced:
+            struct[k] = dict(v)
+        elif isinstance(v, dict) and isinstance(_unwrap(struct.get(k)), dict):
+            struct[k] = _overlay_struct(v, _unwrap(struct[k]))
+        else:
+            struct[k] = v
+    return struct
+
+
+class FrozenConfiguration(Mapping):
+    """ Immutable snapshot of a configured :class:`Configuration`
+
+    Built by :meth:`Configuration.freeze`. Keys which are valid identifiers
+    (and do not start with ``_`` or clash with a method) are stored in slots
+    of a class generated per key set, the rest are reachable through item
+    access only. Any write raises :class:`ConfigurationError`.
+    """
+
+    __slots__ = ('__data', '_parent', '_pwd')
+
+    def __getitem__(self, name):
+        return self.__data[name]
+
+    def __iter__(self):
+        return iter(self.__data)
+
+    def __contains__(self, name):
+        return name in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __getattr__(self, name):
+        if name[:2] == '__':
+            raise AttributeError(name)
+        return self[name]
+
+    def __setattr__(self, name, value):
+        raise ConfigurationError("frozen configuration is read-only")
+
+    def __delattr__(self, name):
+        raise ConfigurationError("frozen configuration is read-only")
+
+    def __setitem__(self, name, value):
+        raise ConfigurationError("frozen configuration is read-only")
+
+    def __delitem__(self, name):
+        raise ConfigurationError("frozen configuration is read-only")
+
+    @property
+    def _root(self):
+        c = self
+        while c._parent is not None:
+            c = c._parent
+        return c
+
+    def by_ref(self, path, value=None):
+        if value is not None:
+            raise ConfigurationError("frozen configuration is read-only")
+
+        up, keys = _parse_ref(path)
+        node = _ref_base(self, up, path)
+        for i, key in enumerate(keys[:-1]):
+            node = node[key]
+            if not isinstance(node, FrozenConfiguration):
+                return _get_attrs(node, keys[i + 1:])
+        return node[keys[-1]]
+
+    def to_dict(self):
+        """Converts snapshot to a dictionary, frozen lists become lists again."""
+        return _thaw(self)
+
+    def __repr__(self):
+        return repr(self.__data)
+
+    __str__ = __repr__
+
+
+class _FrozenList(tuple):
+    """ Tuple standing for a list of a frozen configuration """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+@lru_cache(maxsize=1024)
+def _frozen_class(keys):
+    slots = sorted(k for k in keys
+                   if isinstance(k, str) and k.isidentifier() and k[:1] != '_'
+                   and not hasattr(FrozenConfiguration, k))
+    return _frozen_slots_class(tuple(slots))
+
+
+@lru_cache(maxsize=256)
+def _frozen_slots_class(slots):
+    return type('FrozenConfiguration', (FrozenConfiguration,), {'__slots__': slots})
+
+
+def _freeze_mapping(struct, parent, pwd):
+    """ Freeze the ``struct`` mapping into a :class:`FrozenConfiguration`
+
+    Mapping nodes are created top-down so their children can point to them,
+    and filled bottom-up since frozen lists are tuples of frozen items.
+    """
+    setattr_ = object.__setattr__
+    # containers in discovery order as [source, parent, pwd, frozen, entries
+    # of the items (None for the ones that are not containers), depth]
+    root = [struct, parent, pwd, None, None, 0]
+    entries = [root]
+    stack = [root]
+    # containers on the way to the current one, to report cycles
+    path = {}
+    while stack:
+        entry = stack.pop()
+        value, parent, pwd = entry[:3]
+        depth = entry[5] + 1
+        _descend(path, value, entry[5])
+        if isinstance(value, dict):
+            node = entry[3] = object.__new__(_frozen_class(tuple(value)))
+            setattr_(node, '_FrozenConfiguration__data', {})
+            setattr_(node, '_parent', parent)
+            setattr_(node, '_pwd', pwd)
+            parent, items = node, value.values()
+        else:
+            items = value
+        kids = entry[4] = []
+        for v in items:
+            cls = v.__class__
+            if cls in _SCALARS:
+                kid = None
+            elif cls is dict or cls is list or isinstance(v, (dict, list)):
+                kid = [v, parent, pwd, None, None, depth]
+            elif isinstance(v, Configuration):
+                kid = [v._Configuration__struct, parent, v._pwd, None, None, depth]
+            else:
+                kid = None
+            if kid is not None:
+                if id(kid[0]) in path:
+                    raise ConfigurationError("cannot freeze a cyclic configuration")
+                entries.append(kid)
+                stack.append(kid)
+            kids.append(kid)
+
+    for entry in reversed(entries):
+        value, kids = entry[0], entry[4]
+        if isinstance(value, dict):
+            node = entry[3]
+            data = node._FrozenConfiguration__data
+            for (k, v), kid in zip(value.items(), kids):
+                data[k] = v if kid is None else kid[3]
+            for k in node.__class__.__slots__:
+                setattr_(node, k, data[k])
+        else:
+            entry[3] = _FrozenList(v if kid is None else kid[3] for v, kid in zip(value, kids))
+    return root[3]
+
+
+def _thaw(value):
+    """ Convert the frozen nodes and lists of ``value`` back to dicts and
+    lists """
+    if isinstance(value, FrozenConfiguration):
+        new = {}
+    elif isinstance(value, _FrozenList):
+        new = []
+    else:
+        return value
+    stack = [(value, new)]
+    while stack:
+        src, dst = stack.pop()
+        if isinstance(src, FrozenConfiguration):
+            items = src._FrozenConfiguration__data.items()
+        else:
+            dst.extend(src)
+            items = enumerate(src)
+        for k, v in items:
+            if isinstance(v, FrozenConfiguration):
+                copy = {}
+            elif isinstance(v, _FrozenList):
+                copy = []
+            else:
+                dst[k] = v
+                continue
+            stack.append((v, copy))
+            dst[k] = copy
+    return new
+
+
+@Configuration.add_constructor('timedelta', cacheable=True)
 def _timedelta_contructor(loader, node):
     item = loader.construct_scalar(node)
 
@@ -354,7 +1872,7 @@ def _timedelta_contructor(loader, node):
             "value '%s' cannot be interpreted as date range" % item)
 
 
-@Configuration.add_constructor('concat')
+@Configuration.add_constructor('concat', cacheable=True)
 def _concatenate_var_constructor(loader, node):
     node = loader.construct_scalar(node)
 
@@ -368,8 +1886,10 @@ def _concatenate_var_constructor(loader, node):
         if item[0] in ['"', "'"]:
             result.append(item.strip('"\''))
         elif item.startswith('ENV:'):
-            result.append(get_envvar(item, silent=False))
+            result.append(_loader_getenv(loader, item))
         else:
+            # imported values may change, from a process to another
+            _uncacheable(loader, '!concat')
             result.append(import_string(item))
 
     return "".join(result)
@@ -388,7 +1908,7 @@ _bytesize_string_pattern = re.compile(
 )
 
 
-@Configuration.add_constructor('bytesize')
+@Configuration.add_constructor('bytesize', cacheable=True)
 def _bytesize_constructor(loader, node):
     item = loader.construct_scalar(node)
 
@@ -421,7 +1941,7 @@ def _bytesize_constructor(loader, node):
     return round(num)
 
 
-@Configuration.add_constructor('re')
+@Configuration.add_constructor('re', cacheable=True)
 def _re_constructor(loader, node):
     item = loader.construct_scalar(node)
 
@@ -432,7 +1952,7 @@ def _re_constructor(loader, node):
     return re_compile(item)
 
 
-@Configuration.add_constructor('envvar')
+@Configuration.add_constructor('envvar', cacheable=True)
 def _env_var_constructor(loader, node):
     node = loader.construct_scalar(node)
 
@@ -440,29 +1960,459 @@ def _env_var_constructor(loader, node):
         raise ConfigurationError(
             "value '%s' cannot be interpreted as environment variable" % node)
 
-    return get_envvar(node, silent=False)
+    return _loader_getenv(loader, node)
 
 
 _env_var_pattern = re.compile(r'^ENV:[a-zA-Z][a-zA-Z0-9_]*(?:\?.*)?$')
 Configuration.add_implicit_resolver('envvar', _env_var_pattern)
 
 
+class IncludeGraph(object):
+    """ Dependency graph of the files pulled in by ``!include:`` and
+    ``!extends:`` directives
+
+    Built by :meth:`Configuration.configure` before any directive runs, so
+    every file is read once per pass and include cycles are reported up
+    front. ``edges`` maps each file (absolute path, ``None`` for a root not
+    read from a file) to the files it includes or extends in order of
+    appearance, ``order`` lists files after everything they depend on.
+    """
+
+    def __init__(self, max_workers=None, environment=None):
+        self.root = None
+        self.edges = {}
+        self.order = []
+        self.max_workers = max_workers
+        # _Environment snapshot files are parsed with
+        self.environment = environment
+        self._structs = {}
+        self._targets_of = {}
+        self._errors = {}
+
+    def resolve(self, filename, struct, pwd):
+        """ Walk the graph from the ``filename`` root, whose parsed struct is
+        ``struct``, loading every file it depends on """
+        self.root = filename
+        self.edges[filename] = []
+        targets = self._targets(struct, pwd)
+        if self.max_workers:
+            self._prefetch(targets)
+        chain = [filename]
+        stack = [(filename, iter(targets))]
+        while stack:
+            node, targets = stack[-1]
+            for target in targets:
+                if target not in self.edges[node]:
+                    self.edges[node].append(target)
+                if target in chain:
+                    raise ConfigurationError("include cycle: %s" % " -> ".join(
+                        "<string>" if f is None else f for f in chain + [target]))
+                if target in self.edges:
+                    continue
+                self.edges[target] = []
+                chain.append(target)
+                stack.append((target, iter(self._file_targets(target))))
+                break
+            else:
+                stack.pop()
+                chain.pop()
+                if node is not None:
+                    self.order.append(node)
+
+    async def aresolve(self, filename, struct, pwd):
+        """ Coroutine version of :meth:`resolve`, files are loaded in the
+        default executor and independent ones concurrently """
+        loop = get_running_loop()
+        seen = set(self._structs)
+
+        def unseen(targets):
+            targets = [t for t in targets if t not in seen]
+            seen.update(targets)
+            return targets
+
+        async def fetch(target):
+            try:
+                self._structs[target] = await loop.run_in_executor(
+                    None, partial(Configuration._parse_file, target, environment=self.environment))
+            except Exception as e:
+                self._errors[target] = e
+            else:
+                await gather(*(fetch(t) for t in unseen(self._file_targets(target))))
+
+        await gather(*(fetch(t) for t in unseen(self._targets(struct, pwd))))
+        self.resolve(filename, struct, pwd)
+
+    def load(self, filename):
+        """ Return a copy of the parsed struct of ``filename`` """
+        return _copy_struct(self._struct(filename))
+
+    def release(self):
+        """ Drop parsed structs kept for the current pass """
+        self._structs.clear()
+        self._targets_of.clear()
+        self._errors.clear()
+
+    def _struct(self, filename):
+        try:
+            return self._structs[filename]
+        except KeyError:
+            pass
+        if filename in self._errors:
+            # failed on a worker, raised when a sequential load would have
+            raise self._errors.pop(filename)
+        struct = self._structs[filename] = Configuration._parse_file(filename, environment=self.environment)
+        return struct
+
+    def _file_targets(self, filename):
+        try:
+            return self._targets_of[filename]
+        except KeyError:
+            targets = self._targets_of[filename] = self._targets(self._struct(filename), path.dirname(filename))
+            return targets
+
+    def _prefetch(self, targets):
+        """ Read and parse every file reachable from ``targets`` on a pool of
+        ``max_workers`` threads """
+        seen = set(self._structs)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def submit(targets):
+                for target in targets:
+                    if target not in seen:
+                        seen.add(target)
+                        pending[executor.submit(Configuration._parse_file, target,
+                                                environment=self.environment)] = target
+
+            submit(targets)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target = pending.pop(future)
+                    try:
+                        self._structs[target] = future.result()
+                    except Exception as e:
+                        self._errors[target] = e
+                    else:
+                        submit(self._file_targets(target))
+
+    @staticmethod
+    def _targets(struct, pwd):
+        targets = []
+        for d in _iter_directives(struct):
+            if isinstance(d, (Include, Extends)):
+                target = path.abspath(path.join(pwd, d.filename))
+                if target not in targets:
+                    targets.append(target)
+        return targets
+
+
+class _Session(object):
+    """ State shared by a root configuration and the files it pulls in
+    while it is configured """
+
+    __slots__ = ('graph', 'factories', 'resolving', 'lazy')
+
+    def __init__(self, max_workers=None, lazy=False, environment=None):
+        self.graph = IncludeGraph(max_workers=max_workers, environment=environment)
+        # directives are resolved on first access
+        self.lazy = lazy
+        # references being resolved, to report cycles
+        self.resolving = {}
+        # _FactoryMemo when objects built by factories are to be reused
+        self.factories = None
+
+
+class _FactoryMemo(object):
+    """ Objects built by factories during a pass, and the ones built by the
+    previous pass to reuse when a factory is called with the same arguments
+    again """
+
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.built = {}
+
+    def call(self, factory, args, kwargs):
+        try:
+            candidates = self.previous.get(factory, ())
+        except TypeError:
+            # an unhashable factory cannot be remembered, it is always called
+            return factory(*args, **kwargs)
+        for i, (a, kw, obj) in enumerate(candidates):
+            if _same(a, args) and _same(kw, kwargs):
+                del candidates[i]
+                break
+        else:
+            obj = factory(*args, **kwargs)
+        self.built.setdefault(factory, []).append((args, kwargs, obj))
+        return obj
+
+
+def _same(a, b):
+    try:
+        return a is b or bool(a == b)
+    except Exception:
+        return False
+
+
+def _iter_directives(value):
+    """ Yield directives found in ``value`` in order of appearance,
+    including those nested in factory and extends arguments, containers
+    found several times (YAML anchors) are walked once """
+    stack = [value]
+    seen = set()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (dict, list)):
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            stack.extend(reversed(list(value.values())) if isinstance(value, dict) else reversed(value))
+        elif isinstance(value, Directive):
+            yield value
+            if isinstance(value, (Factory, Extends)):
+                stack.append(value.config)
+        elif isinstance(value, Configuration):
+            stack.append(value._Configuration__struct)
+
+
+async def _await_values(struct):
+    """ Await every awaitable found in ``struct`` and put its result in
+    its place, an awaitable found in several places is awaited once """
+    found = []
+    stack = [struct]
+    # containers found several times (YAML anchors) are looked into once
+    seen = set()
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        if isinstance(value, (dict, list)):
+            seen.add(id(value))
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        elif isinstance(value, Configuration):
+            stack.append(value._Configuration__struct)
+            continue
+        else:
+            continue
+        for k, v in items:
+            if isawaitable(v):
+                found.append((value, k, v))
+            else:
+                stack.append(v)
+
+    if found:
+        awaitables = {id(a): a for _, _, a in found}
+        results = dict(zip(awaitables, await gather(*awaitables.values())))
+        for container, key, awaitable in found:
+            container[key] = results[id(awaitable)]
+
+
 class Directive(object):
 
     def __call__(self, ctx):
         raise NotImplementedError()
 
 
+class _Thunk(object):
+    """ Value left pending by a lazy :meth:`Configuration.configure` """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return '<pending %r>' % (self.value,)
+
+
+def _configure_value(v, ctx):
+    if isinstance(v, Directive):
+        return v(ctx)
+    if isinstance(v, Configuration):
+        return v.configure(_root=False)
+    if isinstance(v, list):
+        _configure_tree(ctx, v, False)
+    return v
+
+
+def _configure_tree(ctx, container, lazy):
+    """ Run the directives found in ``container`` and below, replacing each
+    of them by its result in place
+
+    ``ctx`` is the view over ``container``, or over the mapping holding it
+    when ``container`` is a list. The tree is walked with an explicit stack
+    and every container is visited once, so deep trees do not hit the
+    recursion limit. Views over nested mappings are only built for the ones
+    holding directives; directives in lists get the view of the mapping
+    holding the list.
+
+    With ``lazy`` set, directives in mappings and lists holding directives
+    are wrapped in :class:`_Thunk` instead, see :meth:`Configuration.configure`.
+    """
+    while isinstance(container, Configuration):
+        container = container._Configuration__struct
+    if container is None:
+        return
+    # dotted paths are only tracked while tracing
+    tracer = Configuration._tracer
+    # frames of mappings: [mapping, view or None, parent frame, key], the key
+    # is None for mappings held in lists
+    stack = [(container, [container, ctx, None, None], _view_path(ctx) if tracer else None)]
+    seen = set()
+    while stack:
+        container, frame, where = stack.pop()
+        if container is _reparent:
+            # the tree of an included configuration is configured, it can
+            # join the including one
+            view, k, r = frame
+            view[k] = r
+            continue
+        if id(container) in seen:
+            continue
+        seen.add(id(container))
+        if isinstance(container, dict):
+            items = container.items()
+            in_dict = True
+        else:
+            items = enumerate(container)
+            in_dict = False
+        for k, v in items:
+            if isinstance(v, dict):
+                stack.append((v, [v, None, frame, k if in_dict else None], where + (k,) if tracer else None))
+            elif isinstance(v, list):
+                if lazy and in_dict and _holds_directive(v):
+                    container[k] = _Thunk(v)
+                else:
+                    stack.append((v, frame, where + (k,) if tracer else None))
+            elif isinstance(v, Directive):
+                if lazy and in_dict and not isinstance(v, (Include, Extends)):
+                    container[k] = _Thunk(v)
+                    continue
+                view = _frame_view(frame)
+                # included trees are configured by this loop rather than by
+                # a nested configure(), so long include chains do not recurse
+                include = v.__class__ is Include
+                if tracer is None:
+                    r = _open_include(view, v.filename) if include else v(view)
+                elif include:
+                    r = _trace(tracer, 'directive', str(v), _dotted(where + (k,)), _view_source(view),
+                               _open_include, view, v.filename)
+                else:
+                    r = _trace(tracer, 'directive', str(v), _dotted(where + (k,)), _view_source(view), v, view)
+                if include:
+                    r, pending = r
+                    struct = r._Configuration__struct if pending else None
+                    if struct is not None:
+                        # it stays its own root (for absolute references)
+                        # until its tree is configured, the frame below it
+                        # reparents it then
+                        if in_dict:
+                            stack.append((_reparent, (view, k, r), None))
+                        stack.append((struct, [struct, r, None, None], _view_path(r) if tracer else None))
+                        container[k] = r
+                        continue
+                if in_dict:
+                    view[k] = r
+                else:
+                    container[k] = r
+            elif isinstance(v, Configuration):
+                struct = v._Configuration__struct
+                while isinstance(struct, Configuration):
+                    struct = struct._Configuration__struct
+                if struct is not None:
+                    stack.append((struct, [struct, v, None, None], where + (k,) if tracer else None))
+
+
+# marks the frames of _configure_tree reparenting an included configuration
+_reparent = object()
+
+
+def _frame_view(frame):
+    """ Return the view of a :func:`_configure_tree` frame, building the
+    missing views of its ancestors on the way """
+    pending = []
+    while frame[1] is None:
+        pending.append(frame)
+        frame = frame[2]
+    view = frame[1]
+    for frame in reversed(pending):
+        if frame[3] is None:
+            view = frame[1] = view.__class__(frame[0], parent=view, pwd=view._pwd)
+        else:
+            view = frame[1] = view._child(frame[3], frame[0])
+    return view
+
+
+def _holds_directive(value):
+    stack = [value]
+    # containers found several times (YAML anchors) are looked into once
+    seen = set()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (dict, list)):
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            stack.extend(value.values() if isinstance(value, dict) else value)
+        elif isinstance(value, Directive):
+            return True
+    return False
+
+
 class Ref(Directive):
 
     def __init__(self, ref):
         self.ref = ref
+        self.path = _parse_ref(ref)
 
     def __call__(self, ctx):
-        o = ctx.by_ref(self.ref)
-        if isinstance(o, Factory):
-            return ctx.by_ref(self.ref, o(ctx))
-        return o
+        session = ctx._root._session
+        resolving = session.resolving if session is not None else {}
+        # references are followed in a loop, every node holding one of them
+        # gets the final value so it is resolved once whatever the chain
+        followed = []
+        ref, node = self, ctx
+        try:
+            while True:
+                node, key, value = ref._target(node, resolving)
+                if key is None or not isinstance(value, Directive):
+                    break
+                marker = _enter(resolving, node, key, ref.ref)
+                followed.append((marker, node, key))
+                if not isinstance(value, Ref):
+                    value = value(node)
+                    break
+                ref = value
+        finally:
+            for marker, _, _ in followed:
+                del resolving[marker]
+        for _, node, key in followed:
+            node[key] = value
+        return value
+
+    def _target(self, ctx, resolving):
+        """ Return node and key this reference points to, and the value
+        found there. Node and key are ``None`` when the value was reached
+        through attributes of a plain object. """
+        up, keys = self.path
+        node = _ref_base(ctx, up, self.ref)
+        for i, key in enumerate(keys[:-1]):
+            value = node[key]
+            if isinstance(value, Directive):
+                marker = _enter(resolving, node, key, self.ref)
+                try:
+                    value = value(node)
+                finally:
+                    del resolving[marker]
+                node[key] = value
+            if not isinstance(value, Configuration):
+                return None, None, _get_attrs(value, keys[i + 1:])
+            node = value
+        return node, keys[-1], node[keys[-1]]
 
     def __str__(self):
         return '%s(%s)' % (self.__class__.__name__, self.ref)
@@ -470,7 +2420,16 @@ class Ref(Directive):
     __repr__ = __str__
 
 
-@Configuration.add_multi_constructor('ref')
+def _enter(resolving, node, key, ref):
+    marker = (id(node._Configuration__struct), key)
+    if marker in resolving:
+        chain = list(resolving.values())[list(resolving).index(marker):]
+        raise ConfigurationError("reference cycle: %s" % " -> ".join(chain + [ref]))
+    resolving[marker] = ref
+    return marker
+
+
+@Configuration.add_multi_constructor('ref', cacheable=True)
 def _ref_constructor(loader, tag, node):
     return Ref(tag)
 
@@ -489,48 +2448,54 @@ class Factory(Directive):
                 factory = import_string(factory)
             except ImportStringError as e:
                 raise ConfigurationError("cannot import factory: %s" % e)
-        if isinstance(factory, FunctionType):
-            argspec = signature(factory)
-        elif isinstance(factory, type):
-            argspec = signature(factory.__init__)
-            argspec = argspec._replace(args=argspec.args[1:])
-        else:
+        if not callable(factory):
             raise ConfigurationError("cannot import factory type: %s" % str(self.factory))
+        try:
+            plan = _call_plan(factory)
+        except TypeError:
+            # unhashable callable
+            plan = _call_plan.__wrapped__(factory)
+        positional, keywords, varkw = plan
 
         args = []
         kwargs = {}
 
-        pos_cut = len(argspec.args) - len(argspec.defaults or [])
-
-        for a in argspec.args[:pos_cut]:
-            if a not in config:
+        for i, (a, required) in enumerate(positional):
+            if a in config:
+                if len(args) < i:
+                    raise ConfigurationError(
+                        "cannot pass '%s' argument without the previous ones for %s" % (a, factory))
+                arg = config.pop(a)
+                if isinstance(arg, Directive):
+                    arg = arg(ctx)
+                args.append(arg)
+            elif required:
                 raise ConfigurationError(
                     "missing '%s' argument for %s" % (a, factory))
-            arg = config.pop(a)
-            if isinstance(arg, Directive):
-                arg = arg(ctx)
-            args.append(arg)
 
-        for a in argspec.args[pos_cut:]:
+        for a, required in keywords:
             if a in config:
                 arg = config.pop(a)
                 if isinstance(arg, Directive):
                     arg = arg(ctx)
                 kwargs[a] = arg
+            elif required:
+                raise ConfigurationError(
+                    "missing '%s' argument for %s" % (a, factory))
 
-        if argspec.varkw:
-            try:
-                while True:
-                    k, arg = config.popitem()
-                    if isinstance(arg, Directive):
-                        arg = arg(ctx)
-                    kwargs[k] = arg
-            except KeyError:
-                pass
+        if varkw:
+            for k, arg in config.items():
+                if isinstance(arg, Directive):
+                    arg = arg(ctx)
+                kwargs[k] = arg
+            config = None
 
         if config:
             raise ConfigurationError(
                 "extra arguments '%s' found for %s" % (config, factory))
+        session = ctx._root._session
+        if session is not None and session.factories is not None:
+            return session.factories.call(factory, args, kwargs)
         return factory(*args, **kwargs)
 
     def __str__(self):
@@ -539,7 +2504,7 @@ class Factory(Directive):
     __repr__ = __str__
 
 
-@Configuration.add_multi_constructor('factory')
+@Configuration.add_multi_constructor('factory', cacheable=True)
 def _factory_constructor(loader, tag, node):
     if node.value:
         item = loader.construct_mapping(node, deep=True)
@@ -559,8 +2524,13 @@ class Obj(Directive):
         except ImportStringError as e:
             raise ConfigurationError("cannot import obj: %s" % e)
 
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.obj)
+
+    __repr__ = __str__
+
 
-@Configuration.add_multi_constructor('obj')
+@Configuration.add_multi_constructor('obj', cacheable=True)
 def _obj_constructor(loader, tag, node):
     return Obj(tag)
 
@@ -571,10 +2541,35 @@ class Include(Directive):
         self.filename = filename
 
     def __call__(self, ctx):
-        return Configuration.from_file(path.join(ctx._pwd, self.filename))
+        return _include(ctx, self.filename)
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.filename)
+
+    __repr__ = __str__
+
 
+def _include(ctx, filename):
+    cfg, pending = _open_include(ctx, filename)
+    return cfg.configure() if pending else cfg
 
-@Configuration.add_multi_constructor('include')
+
+def _open_include(ctx, filename):
+    """ Return the configuration of ``filename`` included from ``ctx``, and
+    whether its tree is still to be configured by the caller """
+    filename = path.abspath(path.join(ctx._pwd, filename))
+    session = ctx._root._session
+    if session is None:
+        return Configuration.from_file(filename), False
+    cfg = Configuration(session.graph.load(filename), pwd=path.dirname(filename))
+    cfg._source = filename
+    cfg._session = session
+    if isinstance(cfg._Configuration__struct, Extends):
+        return cfg.configure(), False
+    return cfg, True
+
+
+@Configuration.add_multi_constructor('include', cacheable=True)
 def _include_constructor(loader, tag, node):
     return Include(tag)
 
@@ -597,8 +2592,13 @@ class Directory(Directive):
             raise ConfigurationError("'%s' is not a directory" % self._path)
         return str(path)
 
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self._path)
 
-@Configuration.add_constructor('directory')
+    __repr__ = __str__
+
+
+@Configuration.add_constructor('directory', cacheable=True)
 def _directory_constructor(loader, node):
     item = loader.construct_scalar(node)
 
@@ -616,9 +2616,10 @@ class Extends(Directive):
         self.config = config
 
     def __call__(self, ctx):
-        sup = Configuration.from_file(path.join(ctx._pwd, self.filename))
-        cfg = Configuration.from_dict(self.config, pwd=ctx._pwd)
-        return sup + cfg
+        sup = _include(ctx, self.filename)
+        cfg = Configuration(self.config, pwd=ctx._pwd)
+        cfg._session = ctx._root._session
+        return sup + cfg.configure()
 
     def __iter__(self):
         return iter(self.config)
@@ -627,13 +2628,20 @@ class Extends(Directive):
         return self.config[name]
 
     def __getattr__(self, name):
+        if name == 'config' or name[:2] == '__':
+            raise AttributeError(name)
         return getattr(self.config, name)
 
     def __contains__(self, name):
         return name in self.config
 
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.filename)
+
+    __repr__ = __str__
+
 
-@Configuration.add_multi_constructor('extends')
+@Configuration.add_multi_constructor('extends', cacheable=True)
 def _extends_constructor(loader, tag, node):
     item = loader.construct_mapping(node, deep=True)
     return Extends(tag, item)
@@ -646,6 +2654,304 @@ def _logging_constructor(loader, node):
     configure_logging(config, disable_existing_loggers=disable_existing_loggers)
 
 
+class Tracer(object):
+    """ Receives the phases of loading and configuring, see
+    :meth:`Configuration.enable_tracing`
+
+    ``phase`` is one of:
+
+    * ``file``: reading a file and everything done at parse time (``name``
+      is its path);
+    * ``parse``: YAML parsing, constructors included;
+    * ``constructor``: a constructor such as ``!envvar`` or ``!concat``
+      (``name`` is the tag);
+    * ``import``: :func:`import_string` importing a name not cached yet;
+    * ``includes``: loading every file included or extended by a root file;
+    * ``configure``: configuring a file;
+    * ``directive``: a directive such as ``!factory:`` or ``!include:``
+      (``name`` is the directive).
+
+    ``path`` is the dotted path of the value being resolved within
+    ``source``, the file it comes from, when known. Phases nest, the duration (in
+    seconds) of a phase includes the ones inside it.
+    """
+
+    def start(self, phase, name, path, source):
+        pass
+
+    def end(self, phase, name, path, source, duration):
+        pass
+
+
+class SlowestTracer(Tracer):
+    """ Tracer keeping the ``n`` slowest items """
+
+    def __init__(self, n=20):
+        self.n = n
+        self._heap = []
+        self._counter = 0
+
+    def end(self, phase, name, path, source, duration):
+        self._counter += 1
+        item = (duration, self._counter, phase, name, path, source)
+        if len(self._heap) < self.n:
+            heappush(self._heap, item)
+        else:
+            heappushpop(self._heap, item)
+
+    @property
+    def slowest(self):
+        """ ``(duration, phase, name, path, source)`` tuples, slowest first """
+        return [(d, phase, name, path, source) for d, _, phase, name, path, source in sorted(self._heap, reverse=True)]
+
+    def clear(self):
+        self._heap = []
+
+    def format(self):
+        lines = []
+        for duration, phase, name, key_path, source in self.slowest:
+            where = ' '.join(x for x in (key_path and 'at %s' % key_path, source and 'in %s' % source) if x)
+            lines.append('%10.3f ms  %-11s %s%s' % (duration * 1000, phase, name, where and ' ' + where))
+        return '\n'.join(lines)
+
+    def print(self, file=None):
+        print(self.format(), file=file)
+
+
+def _trace(tracer, phase, name, path, source, func, *args):
+    tracer.start(phase, name, path, source)
+    start = perf_counter()
+    try:
+        return func(*args)
+    finally:
+        tracer.end(phase, name, path, source, perf_counter() - start)
+
+
+def _dotted(keys):
+    return '.'.join(str(k) for k in keys)
+
+
+def _view_path(view):
+    """ Keys leading from the root to ``view``, only used while tracing """
+    keys = []
+    while view._parent is not None:
+        parent = view._parent
+        struct = parent._Configuration__struct
+        while isinstance(struct, Configuration):
+            struct = struct._Configuration__struct
+        data = view._Configuration__struct
+        keys.append(next((k for k, v in struct.items() if v is data or v is view), '?'))
+        view = parent
+    return tuple(reversed(keys))
+
+
+def _view_source(view):
+    while view is not None:
+        if view._source is not None:
+            return view._source
+        view = view._parent
+    return None
+
+
+class ConfigWatcher(object):
+    """ Keep a configuration read from ``filename`` up to date
+
+    The file and every file it includes or extends are watched, with
+    inotify where available and by polling their modification time and
+    size otherwise. On change only modified files, and the ones reading an
+    environment variable whose value changed, are parsed again, the
+    configuration is rebuilt reusing the objects of every factory called
+    with unchanged arguments, and callbacks subscribed to dotted paths
+    whose value changed are called with the old and new values.
+
+    Call :meth:`check` (from a SIGHUP handler, for instance) or
+    :meth:`start` a background thread checking every ``interval`` seconds.
+    """
+
+    def __init__(self, filename, interval=1.0, ctx=None, pwd=None, constructors=None,
+                 multi_constructors=None, implicit_resolvers=None, use_inotify=True):
+        self.filename = path.abspath(filename)
+        self.interval = interval
+        self._ctx = ctx
+        self._pwd = pwd or path.dirname(self.filename)
+        self._loader_kwargs = {
+            "constructors": constructors,
+            "multi_constructors": multi_constructors,
+            "implicit_resolvers": implicit_resolvers,
+        }
+        self._subscribers = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        # pristine structs of the files read, by filename
+        self._structs = {}
+        # objects built by factories, see _FactoryMemo
+        self._factories = None
+        # (st_mtime_ns, st_size, st_ino) of watched files
+        self._signatures = {}
+        # environment variables read by each file, see _Environment
+        self._env_files = {}
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError):
+                pass
+
+        self.config = self._build({self.filename: _signature(self.filename)})
+
+    @property
+    def files(self):
+        """ Files being watched """
+        return set(self._signatures)
+
+    def subscribe(self, path, callback):
+        """ Call ``callback(old, new)`` when the value at dotted ``path``
+        changes, ``None`` stands for a missing value """
+        self._subscribers.append((path, callback))
+        return callback
+
+    def check(self):
+        """ Reload the configuration if any watched file, or environment
+        variable read by one, changed
+
+        :return: whether it was reloaded
+        """
+        with self._lock:
+            signatures = {f: _signature(f) for f in self._signatures}
+            changed = [f for f, sig in signatures.items()
+                       if sig != self._signatures[f] or _env_changed(self._env_files.get(f, {}))]
+            if not changed:
+                return False
+            for filename in changed:
+                self._structs.pop(filename, None)
+
+            old, self.config = self.config, self._build(signatures)
+
+        for ref, callback in self._subscribers:
+            old_value, new_value = _get_ref(old, ref), _get_ref(self.config, ref)
+            if not _same(old_value, new_value):
+                callback(old_value, new_value)
+        return True
+
+    def start(self):
+        """ Check for changes in a daemon thread until :meth:`stop` """
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = Thread(target=self._run, name="ConfigWatcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self._inotify is not None:
+                self._inotify.wait(self.interval)
+            else:
+                self._stopped.wait(self.interval)
+            if self._stopped.is_set():
+                break
+            try:
+                self.check()
+            except Exception:
+                logger.exception("cannot reload configuration from '%s'", self.filename)
+
+    def _build(self, signatures):
+        environment = _Environment()
+        # files parsed again read the variables of the unchanged ones with
+        # the same values
+        for filename in self._structs:
+            used = environment.files[filename] = self._env_files.get(filename, {})
+            environment.values.update(used)
+        try:
+            struct = self._structs[self.filename]
+        except KeyError:
+            struct = Configuration._parse_file(self.filename, ctx=self._ctx, environment=environment,
+                                               **self._loader_kwargs)
+
+        config = Configuration(_copy_struct(struct), pwd=self._pwd)
+        config._source = self.filename
+        config._environment = environment
+        session = config._session = _Session(environment=environment)
+        session.factories = _FactoryMemo(self._factories)
+        graph = session.graph
+        graph._structs.update(self._structs)
+        graph.resolve(self.filename, config._Configuration__struct, self._pwd)
+        structs = {f: graph._structs[f] for f in graph.edges if f in graph._structs}
+        structs[self.filename] = struct
+        try:
+            config.configure()
+        finally:
+            graph.release()
+
+        self._structs = structs
+        self._env_files = {f: environment.files.get(f, {}) for f in structs}
+        self._factories = session.factories.built
+        self._signatures = {f: signatures.get(f) or _signature(f) for f in structs}
+        if self._inotify is not None:
+            self._inotify.watch(path.dirname(f) for f in structs)
+        return config
+
+
+def _signature(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _get_ref(config, ref):
+    try:
+        return config.by_ref(ref)
+    except (KeyError, AttributeError):
+        return None
+
+
+class _Inotify(object):
+    """ Wait for changes in directories through Linux inotify """
+
+    MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200  # modify, attrib, close write, moved to, create, delete
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = set()
+
+    def watch(self, directories):
+        for directory in set(directories) - self._directories:
+            if self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK) >= 0:
+                self._directories.add(directory)
+
+    def wait(self, timeout):
+        """ Wait up to ``timeout`` seconds for an event, return whether
+        there was one """
+        if not select([self._fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
 def import_string(import_name, silent=False):
     """Imports an object based on a string.  This is useful if you want to
     use import paths as endpoints or something similar.  An import path can
@@ -657,6 +2963,12 @@ def import_string(import_name, silent=False):
     For better debugging we recommend the new :func:`import_module`
     function to be used instead.
 
+    The module an object is taken from is kept in a bounded LRU cache, the
+    object itself is looked up on the module on every call (so patching it,
+    like :func:`unittest.mock.patch` does, is seen). An entry is dropped when
+    its module is no longer the one in ``sys.modules``. Failures of silent
+    calls are cached too, until ``sys.modules`` grows or shrinks.
+
     :param import_name: the dotted name for the object to import.
     :param silent: if set to `True` import errors are ignored and
                    `None` is returned instead.
@@ -664,27 +2976,75 @@ def import_string(import_name, silent=False):
 
     :copyright: (c) 2011 by the Werkzeug Team
     """
+    with _import_cache_lock:
+        entry = _import_cache.get(import_name)
+        if entry is not None:
+            _import_cache.move_to_end(import_name)
+    if entry is not None:
+        module, name, modules = entry
+        if module is None:
+            # failures are only cached for silent calls, until a module is
+            # imported or removed
+            if silent and modules == len(sys.modules):
+                return None
+        elif sys.modules.get(module.__name__) is module:
+            if name is None:
+                return module
+            obj = getattr(module, name, _missing)
+            if obj is not _missing:
+                return obj
+
     try:
-        if ':' in import_name:
-            module, obj = import_name.split(':', 1)
-        elif '.' in import_name:
-            module, obj = import_name.rsplit('.', 1)
+        tracer = Configuration._tracer
+        if tracer is None:
+            module, name = _import_string(import_name)
         else:
-            try:
-                return __import__(import_name)
-            except ImportError:
-                return import_string('__main__.' + import_name)
-        try:
-            return getattr(__import__(module, None, None, [obj]), obj)
-        except (ImportError, AttributeError):
-            # support importing modules not yet set up by the parent module
-            # (or package for that matter)
-            modname = module + '.' + obj
-            __import__(modname)
-            return sys.modules[modname]
+            module, name = _trace(tracer, 'import', import_name, None, None, _import_string, import_name)
     except ImportError as e:
         if not silent:
             raise ImportStringError(import_name, e).with_traceback(sys.exc_info()[2])
+        entry = (None, None, len(sys.modules))
+        obj = None
+    else:
+        entry = (module, name, None)
+        obj = module if name is None else getattr(module, name)
+
+    with _import_cache_lock:
+        _import_cache[import_name] = entry
+        _import_cache.move_to_end(import_name)
+        while len(_import_cache) > _import_cache_size:
+            _import_cache.popitem(last=False)
+    return obj
+
+
+_import_cache = OrderedDict()
+_import_cache_lock = Lock()
+_import_cache_size = 1024
+
+
+def _import_string(import_name):
+    """ Import ``import_name`` and return the module it is taken from with
+    the name of the object in that module, ``None`` when it is the module
+    itself """
+    if ':' in import_name:
+        module_name, obj = import_name.split(':', 1)
+    elif '.' in import_name:
+        module_name, obj = import_name.rsplit('.', 1)
+    else:
+        try:
+            return __import__(import_name), None
+        except ImportError:
+            return _import_string('__main__.' + import_name)
+    try:
+        module = __import__(module_name, None, None, [obj])
+        getattr(module, obj)
+        return module, obj
+    except (ImportError, AttributeError):
+        # support importing modules not yet set up by the parent module
+        # (or package for that matter)
+        modname = module_name + '.' + obj
+        __import__(modname)
+        return sys.modules[modname], None
 
 
 class ImportStringError(ImportError):
@@ -699,9 +3059,19 @@ class ImportStringError(ImportError):
     exception = None
 
     def __init__(self, import_name, exception):
+        ImportError.__init__(self, import_name)
         self.import_name = import_name
         self.exception = exception
+        self._message = None
 
+    def __str__(self):
+        # tracking down which part failed imports every prefix of the name,
+        # only do it when the error is actually shown
+        if self._message is None:
+            self._message = self._format()
+        return self._message
+
+    def _format(self):
         msg = (
             'import_string() failed for %r. Possible reasons are:\n\n'
             '- missing __init__.py in a package;\n'
@@ -714,19 +3084,17 @@ class ImportStringError(ImportError):
 
         name = ''
         tracked = []
-        for part in import_name.replace(':', '.').split('.'):
+        for part in self.import_name.replace(':', '.').split('.'):
             name += (name and '.') + part
             imported = import_string(name, silent=True)
-            if imported:
-                tracked.append((name, imported.__file__))
+            if imported is not None:
+                tracked.append((name, getattr(imported, '__file__', None)))
             else:
-                track = ['- %r found in %r.' % (n, i) for n, i in tracked]
-                track.append('- %r not found.' % name)
-                msg = msg % (import_name, '\n'.join(track),
-                             exception.__class__.__name__, str(exception))
                 break
-
-        ImportError.__init__(self, msg)
+        track = ['- %r found in %r.' % (n, i) for n, i in tracked]
+        track.append('- %r not found.' % name)
+        return msg % (self.import_name, '\n'.join(track),
+                      self.exception.__class__.__name__, str(self.exception))
 
     def __repr__(self):
         return '<%s(%r, %r)>' % (self.__class__.__name__, self.import_name,
@@ -737,15 +3105,25 @@ ENVVAR_REGEX = re.compile(r'^(?:ENV:)?(?P<name>[a-zA-Z_][a-zA-Z_0-9]*)(?P<has_de
                           r'(?:(?P<default_1>[^\"\s]+)|\"(?P<default_2>(?:[^\"]|\\\\|\\\")*)\")?)?$')
 
 
-def get_envvar(envvar, silent=False, **kwargs):
+@lru_cache(maxsize=1024)
+def _parse_envvar(envvar):
+    """ Split ``[ENV:]NAME[?=default]`` into the name and the default,
+    ``_missing`` when there is none """
     match = ENVVAR_REGEX.match(envvar)
-    envvar = match.group('name')
-
+    if match is None:
+        raise ConfigurationError("value '%s' cannot be interpreted as environment variable" % envvar)
+    default = _missing
     if match.group('has_default'):
-        kwargs['default'] = match.group('default_1') or match.group('default_2')
+        default = match.group('default_1') or match.group('default_2')
+        if default:
+            default = default.replace('\\\\', '\\').replace('\\"', '"')
+    return match.group('name'), default
 
-        if kwargs['default']:
-            kwargs['default'] = kwargs['default'].replace('\\\\', '\\').replace('\\"', '"')
+
+def get_envvar(envvar, silent=False, **kwargs):
+    envvar, default = _parse_envvar(envvar)
+    if default is not _missing:
+        kwargs['default'] = default
 
     try:
         return os.environ[envvar]
@@ -759,28 +3137,250 @@ def get_envvar(envvar, silent=False, **kwargs):
         raise ConfigurationError('Environment variable `{}` does not set'.format(envvar))
 
 
-def format_config(config, _lvl=0):
-    indent = "  " * _lvl
-    buf = ""
-    for k, v in sorted(config.items()):
-        buf += "%s%s:\n" % (indent, k)
-        if isinstance(v, Configuration):
-            buf += format_config(v, _lvl + 1)
+class _Environment(object):
+    """ Snapshot of the environment variables read by a load: each one is
+    read from ``os.environ`` once and keeps that value for every file the
+    load parses
+
+    :meth:`scope` returns the view of a single file, sharing the snapshot
+    and recording the variables that file read in ``used``.
+    """
+
+    __slots__ = ('values', 'used', 'files')
+
+    def __init__(self, values=None, files=None):
+        # name -> value, None for variables that are not set
+        self.values = {} if values is None else values
+        self.used = {}
+        # filename -> variables read while parsing it
+        self.files = {} if files is None else files
+
+    def scope(self):
+        return _Environment(self.values, self.files)
+
+    def get(self, name):
+        try:
+            return self.used[name]
+        except KeyError:
+            pass
+        value = self.values.get(name, _missing)
+        if value is _missing:
+            # setdefault keeps the first value read by concurrent parses
+            value = self.values.setdefault(name, os.environ.get(name))
+        self.used[name] = value
+        return value
+
+    def getenv(self, envvar):
+        """ Value of ``[ENV:]NAME[?=default]``, see :func:`get_envvar` """
+        name, default = _parse_envvar(envvar)
+        value = self.get(name)
+        if value is not None:
+            return value
+        if default is _missing:
+            raise ConfigurationError('Environment variable `{}` does not set'.format(name))
+        return default
+
+    def matches(self, used):
+        """ Whether the variables of ``used`` (the ones a file read in
+        another load) have the same values in this snapshot """
+        return all(self.get(name) == value for name, value in used.items())
+
+
+def _env_changed(used):
+    return any(os.environ.get(name) != value for name, value in used.items())
+
+
+def _loader_getenv(loader, envvar):
+    environment = getattr(loader, 'environment', None)
+    if environment is None:
+        return get_envvar(envvar, silent=False)
+    return environment.getenv(envvar)
+
+
+class _Dumper(Dumper):
+    """ YAML dumper of :meth:`Configuration.dump` """
+
+    def represent_undefined(self, data):
+        if isinstance(data, (Directive, _Thunk)):
+            raise ConfigurationError("cannot dump unresolved directive %s, configure first or pass directives=True"
+                                     % _unwrap_thunk(data))
+        raise ConfigurationError("cannot dump %r" % (data,))
+
+    def represent_template(self, data):
+        # the emitter only takes plain strings
+        return self.represent_str(str(data))
+
+
+_Dumper.add_representer(None, _Dumper.represent_undefined)
+_Dumper.add_representer(_Template, _Dumper.represent_template)
+
+
+class _DirectiveDumper(_Dumper):
+    """ YAML dumper writing pending directives back as their tags """
+
+    def represent_directive(self, data):
+        if isinstance(data, _Thunk):
+            return self.represent_data(data.value)
+        if isinstance(data, Ref):
+            return self.represent_scalar('!ref:' + data.ref, '')
+        if isinstance(data, Obj):
+            return self.represent_scalar('!obj:' + data.obj, '')
+        if isinstance(data, Include):
+            return self.represent_scalar('!include:' + data.filename, '')
+        if isinstance(data, Directory):
+            return self.represent_scalar('!directory', data._path)
+        if isinstance(data, Extends):
+            return self.represent_mapping('!extends:' + data.filename, data.config)
+        if isinstance(data, Factory) and isinstance(data.factory, str):
+            return self.represent_mapping('!factory:' + data.factory, data.config)
+        return self.represent_undefined(data)
+
+
+_DirectiveDumper.add_multi_representer(Directive, _DirectiveDumper.represent_directive)
+_DirectiveDumper.add_representer(_Thunk, _DirectiveDumper.represent_directive)
+
+
+def _unwrap_thunk(value):
+    return value.value if isinstance(value, _Thunk) else value
+
+
+def _json_default(value):
+    if isinstance(value, (Directive, _Thunk)):
+        raise ConfigurationError("cannot dump unresolved directive %s, configure first" % _unwrap_thunk(value))
+    raise ConfigurationError("cannot dump %r" % (value,))
+
+
+def _dump(data, stream, format, directives):
+    if format == 'json':
+        if directives:
+            raise ConfigurationError("directives can only be dumped as YAML")
+        # one-shot dumps() is the one using the C encoder
+        stream.write(json.dumps(data, default=_json_default))
+    elif format == 'yaml':
+        yaml_dump(data, stream, Dumper=_DirectiveDumper if directives else _Dumper,
+                  default_flow_style=False, sort_keys=False, allow_unicode=True)
+    else:
+        raise ConfigurationError("unknown dump format '%s'" % format)
+
+
+def write_config(config, stream):
+    """ Write the :func:`format_config` text of ``config`` to the file-like
+    object ``stream`` as it walks the tree """
+    _resolve_pending(config)
+    write = stream.write
+    # the stack holds the mappings on the way to the current one (kept
+    # alive there, overlays are materialized), their ids report cycles
+    root = _mapping_of(config)
+    path = {id(root): None}
+    stack = [(_sorted_items(root), "", root)]
+    while stack:
+        items, indent, _ = stack[-1]
+        for k, v in items:
+            cls = v.__class__
+            if cls is dict or cls not in _SCALARS and isinstance(v, (dict, Configuration, FrozenConfiguration)):
+                mapping = _mapping_of(v)
+                if id(mapping) in path:
+                    raise ConfigurationError("cannot format a cyclic configuration")
+                path[id(mapping)] = None
+                write("%s%s:\n" % (indent, k))
+                stack.append((_sorted_items(mapping), indent + "  ", mapping))
+                break
+            write("%s%s:\n%s  %s\n" % (indent, k, indent, v))
         else:
-            buf += "%s%s\n" % ("  " * (_lvl + 1), v)
-    return buf
+            stack.pop()
+            path.popitem()
 
 
-def print_config(config):
-    print(format_config(config))
+def _mapping_of(value):
+    value = _unwrap(value)
+    if isinstance(value, FrozenConfiguration):
+        return value._FrozenConfiguration__data
+    return value
+
+
+def _sorted_items(mapping):
+    # the underlying dicts of configurations are walked, building no view
+    return iter(sorted(_unwrap(mapping).items()))
+
+
+def format_config(config):
+    buf = io.StringIO()
+    write_config(config, buf)
+    return buf.getvalue()
+
+
+def print_config(config, file=None):
+    stream = sys.stdout if file is None else file
+    write_config(config, stream)
+    stream.write("\n")
 
 
 def obj_by_ref(o, path):
-    for s in path.split("."):
-        o = getattr(o, s)
+    return _get_attrs(o, path.split("."))
+
+
+@lru_cache(maxsize=1024)
+def _call_plan(factory):
+    """ Compile the signature of ``factory`` into ``(positional, keywords,
+    varkw)``: parameters that can only be passed by position and the ones
+    passed by keyword as ``(name, required)`` pairs, and whether extra
+    keyword arguments are accepted
+
+    Callables without an introspectable signature get every argument as a
+    keyword.
+    """
+    try:
+        params = signature(factory).parameters.values()
+    except ValueError:
+        return (), (), True
+    positional = []
+    keywords = []
+    varkw = False
+    for p in params:
+        required = p.default is p.empty
+        if p.kind is p.POSITIONAL_ONLY:
+            positional.append((p.name, required))
+        elif p.kind is p.VAR_KEYWORD:
+            varkw = True
+        elif p.kind is not p.VAR_POSITIONAL:
+            keywords.append((p.name, required))
+    return tuple(positional), tuple(keywords), varkw
+
+
+def _get_attrs(o, names):
+    for name in names:
+        o = getattr(o, name)
     return o
 
 
+@lru_cache(maxsize=4096)
+def _parse_ref(ref):
+    """ Compile a dotted reference into the number of levels to go up from
+    the current node (``None`` to start from the root) and a tuple of keys
+
+    ``a.b`` starts from the root, ``.b`` from the current node, ``..b``
+    from its parent and so on.
+    """
+    up = None
+    if ref[:1] == ".":
+        ref = ref[1:]
+        up = 0
+        while ref[:1] == ".":
+            ref = ref[1:]
+            up += 1
+    return up, tuple(ref.split("."))
+
+
+def _ref_base(node, up, ref):
+    if up is None:
+        return node._root
+    for _ in range(up):
+        node = node._parent
+        if node is None:
+            raise ConfigurationError("reference '%s' goes above the root" % ref)
+    return node
+
+
 def configure_logging(logcfg=None, disable_existing_loggers=True):
     """ Configure logging in a sane way
 
@@ -1,12 +1,25 @@
 """ Tests for configure"""
+import asyncio
+import io
+import json
 import os
 import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 from datetime import timedelta
+from functools import partial
 from os import path
 from pathlib import Path
+from types import ModuleType
 from unittest import TestCase as BaseTestCase
+from unittest import mock
 
-from configure import Configuration, ConfigurationError, Factory
+from configure import (ConfigWatcher, Configuration, ConfigurationError, Factory, FrozenConfiguration,
+                       ImportStringError, Loader, OverlayConfiguration, Ref, SlowestTracer, Tracer, _call_plan, _Thunk,
+                       format_config, import_string, write_config)
 
 TEST_CONCAT_STRING = "base_test"
 
@@ -26,6 +39,24 @@ def kw(**kw):
     return kw
 
 
+def kw_only(a, /, b=1, *, c, **kw):
+    return a, b, c, kw
+
+
+async def double(value):
+    return value * 2
+
+
+class Unhashable(object):
+    __hash__ = None
+
+    def __call__(self, **kw):
+        return A(**kw)
+
+
+u = Unhashable()
+
+
 class TestCase(BaseTestCase):
 
     def config(self, v, ctx=None):
@@ -95,6 +126,29 @@ a: !factory:tests.kw
         self.assertTrue('a' in c.a)
         self.assertTrue('b' in c.a)
 
+    def test_factory_signatures(self):
+        c = self.config("""
+a: !factory:tests.kw_only
+    a: 1
+    c: 3
+    d: 4
+b: !factory:datetime.timedelta
+    seconds: 5
+        """)
+        c.configure()
+        self.assertEqual(c.a, (1, 1, 3, {'d': 4}))
+        self.assertEqual(c.b, timedelta(seconds=5))
+        self.assertEqual(Factory(partial(kw_only, 1, c=2), {'b': 3})(c), (1, 3, 2, {}))
+        with self.assertRaisesRegex(ConfigurationError, "missing 'c' argument"):
+            Factory(kw_only, {'a': 1})(c)
+        with self.assertRaisesRegex(ConfigurationError, "extra arguments"):
+            Factory(A, {'a': 1, 'c': 2})(c)
+
+        _call_plan.cache_clear()
+        for i in range(100):
+            Factory('tests.A', {'a': i})(c)
+        self.assertEqual(_call_plan.cache_info().misses, 1)
+
     def test_graph(self):
         c = self.config("""
 a: !factory:tests.A
@@ -113,6 +167,294 @@ b: !factory:tests.a
         self.assertEqual(c.a.b.b, c.b.b)
         self.assertTrue(c.a.b is c.b)
 
+    def test_lazy(self):
+        c = Configuration.from_string("""
+a: !factory:tests.A
+    a: 1
+b: !obj:tests_missing_module.A
+c: [!obj:tests.A, 1]
+d:
+    e: !obj:tests.a
+f: !ref:a
+        """.strip(), lazy=True)
+        self.assertIsInstance(c._Configuration__struct['a'], _Thunk)
+        self.assertIsInstance(c.a, A)
+        self.assertIs(c.a, c.a)
+        self.assertIs(c.f, c.a)
+        self.assertEqual(c.c, [A, 1])
+        self.assertIs(c.d.e, a)
+        self.assertIsInstance(c._Configuration__struct['b'], _Thunk)
+        with self.assertRaises(ConfigurationError):
+            c.resolve_all()
+
+        c = Configuration.from_string("""
+a: !ref:b
+b: !ref:a
+        """.strip(), lazy=True)
+        with self.assertRaisesRegex(ConfigurationError, "reference cycle: a -> b -> a"):
+            c.a
+
+    def test_lazy_diff_merge_patch(self):
+        def load():
+            return Configuration.from_string('a: !obj:tests.A\nb:\n  c: !obj:tests.a\n', lazy=True)
+
+        eager = self.config('a: !obj:tests.A\nb:\n  c: !obj:tests.a\n')
+        self.assertFalse(load().diff(eager))
+        self.assertFalse(eager.diff(load()))
+        changes = load().diff(self.config('a: !obj:tests.a\n'))
+        self.assertEqual(changes.changed, {('a',): (A, a)})
+        self.assertEqual(changes.removed, {('b',): {'c': a}})
+
+        merged = load().merge({'d': 1})
+        self.assertEqual(merged.to_dict(), {'a': A, 'b': {'c': a}, 'd': 1})
+        merged = Configuration.merge_all([{'a': 1, 'd': 1}, load()])
+        self.assertIs(merged.a, A)
+        self.assertIs(merged.b.c, a)
+
+        patched = load().apply_patch(load().diff(self.config('a: 1\nb:\n  c: !obj:tests.a\n  e: 2\n')))
+        self.assertEqual(patched.to_dict(), {'a': 1, 'b': {'c': a, 'e': 2}})
+        self.assertIs(patched.b.c, a)
+
+    def test_configure_lists_and_deep_trees(self):
+        c = self.config("""
+a: 1
+b:
+    - 1
+    - !obj:tests.A
+    - 1
+    - !obj:tests.A
+    - c: !ref:..a
+      d:
+        - !obj:tests.a
+        """)
+        self.assertEqual(c.b[:4], [1, A, 1, A])
+        self.assertEqual(c.b[4], {'c': 1, 'd': [a]})
+
+        struct = node = {}
+        for _ in range(5000):
+            node['n'] = node = {'a': 1}
+        node['b'] = Ref('..a')
+        Configuration(struct).configure()
+        self.assertEqual(node['b'], 1)
+
+    def test_iter_documents(self):
+        stream = io.StringIO("a: !obj:tests.A\n---\na: 2\nb: !ref:a\n...\n---\n")
+        documents = Configuration.iter_documents(stream)
+        c = next(documents)
+        self.assertIs(c.a, A)
+        self.assertEqual(next(documents).to_dict(), {'a': 2, 'b': 2})
+        self.assertIsNone(next(documents)._Configuration__struct)
+        with self.assertRaises(StopIteration):
+            next(documents)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            name = path.join(tmp, 'docs.conf')
+            with open(name, 'w') as f:
+                f.write('a: "{a}"\n---\na: !include:inc.conf\n')
+            with open(path.join(tmp, 'inc.conf'), 'w') as f:
+                f.write('b: 1\n')
+            documents = list(Configuration.iter_documents(name, ctx={'a': 'x'}))
+            self.assertEqual([d.to_dict() for d in documents], [{'a': 'x'}, {'a': {'b': 1}}])
+
+    def test_merge_all(self):
+        base = self.config("""
+a:
+    b: 1
+    c: [1]
+d: 1
+e:
+    f: 1
+        """)
+        region = self.config("a: {b: 2}")
+        env = {'a': {'g': 3}, 'd': 2}
+        host = self.config("e: 2")
+        merged = Configuration.merge_all([base, region, env, host])
+        self.assertEqual(merged.to_dict(), {'a': {'b': 2, 'c': [1], 'g': 3}, 'd': 2, 'e': 2})
+        self.assertIs(merged.a.c, base.a.c)
+        self.assertEqual(base.to_dict(), {'a': {'b': 1, 'c': [1]}, 'd': 1, 'e': {'f': 1}})
+        self.assertEqual((base + region).to_dict(), {'a': {'b': 2, 'c': [1]}, 'd': 1, 'e': {'f': 1}})
+        self.assertEqual(base.a.b, 1)
+        self.assertIs(base.a._parent, base)
+
+        with self.assertRaisesRegex(ConfigurationError, "unresolveable conflict"):
+            Configuration.merge_all([base, {'d': {'x': 1}}])
+
+    def test_overlay(self):
+        base = self.config("""
+a:
+    b: 1
+    c:
+        d: 2
+e: [1]
+f:
+    g: 1
+        """)
+        o = base.overlay({'a': {'c': {'h': 3}}, 'i': 4})
+        self.assertIsInstance(o, OverlayConfiguration)
+        self.assertEqual(o.a.c.to_dict(), {'d': 2, 'h': 3})
+        self.assertIs(o.e, base.e)
+        self.assertEqual(o.i, 4)
+
+        o.a['b'] = 10
+        o.f['g'] = 20
+        del o.a.c['d']
+        o['e'] = {'x': 1}
+        self.assertEqual(o.to_dict(), {'a': {'b': 10, 'c': {'h': 3}}, 'e': {'x': 1}, 'f': {'g': 20}, 'i': 4})
+        self.assertNotIn('d', o.a.c)
+        self.assertEqual(len(o.a.c), 1)
+        self.assertEqual(base.to_dict(), {'a': {'b': 1, 'c': {'d': 2}}, 'e': [1], 'f': {'g': 1}})
+
+        o = base.overlay()
+        o.a.c['d'] = 5
+        o['f'] = {'j': 1}
+        self.assertEqual(o.f.to_dict(), {'j': 1})
+        materialized = o.materialize()
+        self.assertEqual(materialized.a.c.d, 5)
+        self.assertIs(materialized.e, base.e)
+        self.assertEqual(set(base.diff(o).changed), {('a', 'c', 'd')})
+        self.assertEqual(o.freeze().a.c.d, 5)
+
+        big = Configuration.from_dict({'k%d' % i: {'v': i} for i in range(10000)})
+        tracemalloc.start()
+        try:
+            o = big.overlay({'k1': {'v': 0}})
+            o.k2['v'] = 0
+            size = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(size, 16 * 1024)
+        self.assertEqual((o.k1.v, o.k2.v, o.k3.v), (0, 0, 3))
+
+    def test_overlay_lazy(self):
+        base = Configuration.from_string("""
+a: !obj:tests.A
+b:
+    c: !factory:tests.A {a: 1}
+    d: !ref:..a
+e: !factory:tests.kw {x: 1}
+        """.strip(), lazy=True)
+        o = base.overlay({'b': {'f': 2}, 'e': {'y': 2}})
+        self.assertIs(o.a, A)
+        self.assertEqual(o.b.c.a, 1)
+        self.assertIs(o.b.d, A)
+        self.assertEqual(o.b.f, 2)
+        self.assertEqual(o.e.to_dict(), {'x': 1, 'y': 2})
+
+        o = Configuration.from_string('a:\n  b: !obj:tests.a\nc: !obj:tests.A\n', lazy=True).overlay({'d': 1})
+        self.assertEqual(o.to_dict(), {'a': {'b': a}, 'c': A, 'd': 1})
+        self.assertEqual(o.a.to_dict(), {'b': a})
+
+    def test_to_dict(self):
+        inner = Configuration.from_dict({'x': [1]})
+        shared = {'k': [1]}
+        c = Configuration.from_dict({'a': {'b': [1, {'c': inner}]}, 'd': shared, 'e': [shared, shared]})
+        struct = c._Configuration__struct
+        expected = {'a': {'b': [1, {'c': {'x': [1]}}]}, 'd': {'k': [1]}, 'e': [{'k': [1]}, {'k': [1]}]}
+
+        converted = c.to_dict()
+        self.assertEqual(converted, expected)
+        self.assertIsNot(converted['d'], shared)
+        self.assertIsNot(converted['a']['b'][1]['c']['x'], inner.x)
+        # shared containers are copied wherever they appear
+        self.assertIsNot(converted['e'][0], converted['e'][1])
+        self.assertIsNot(converted['d'], converted['e'][0])
+
+        # only the containers on the way to a configuration are copied
+        exported = c.to_dict(copy=False)
+        self.assertEqual(exported, expected)
+        self.assertIsNot(exported, struct)
+        self.assertIsNot(exported['a']['b'], struct['a']['b'])
+        self.assertIs(exported['d'], shared)
+        self.assertIs(exported['a']['b'][1]['c']['x'], inner.x)
+        self.assertEqual(struct['a']['b'][1]['c'].__class__, Configuration)
+        self.assertIs(c.d.to_dict(copy=False), shared)
+
+        deep = node = {}
+        for _ in range(5000):
+            node['n'] = node = {}
+        node['v'] = [1]
+        node = Configuration.from_dict(deep).to_dict()
+        for _ in range(5000):
+            node = node['n']
+        self.assertEqual(node, {'v': [1]})
+
+        cyclic = self.config('a: &x {b: [1], c: *x}\n')
+        with self.assertRaisesRegex(ConfigurationError, "cyclic"):
+            cyclic.to_dict()
+        self.assertEqual(self.config('a: &x [1]\nb: {c: *x, d: *x}\n').to_dict(), {'a': [1], 'b': {'c': [1], 'd': [1]}})
+
+    def test_dump(self):
+        source = """
+a: !ref:b.c
+b:
+    c: 1
+    d:
+        - 1
+        - !obj:tests.A
+        - e: !ref:b.c
+f: !factory:datetime.timedelta
+    seconds: 2
+g: !directory /tmp
+        """
+        c = Configuration.from_string(source, configure=False)
+        with self.assertRaisesRegex(ConfigurationError, r"unresolved directive Ref\(b.c\)"):
+            c.dump(io.StringIO())
+        out = io.StringIO()
+        c.dump(out, directives=True)
+        self.assertIn("a: !ref:b.c", out.getvalue())
+        self.assertIn("f: !factory:datetime.timedelta", out.getvalue())
+        loaded = Configuration.from_string(out.getvalue())
+        self.assertEqual(loaded.a, 1)
+        self.assertIs(loaded.b.d[1], A)
+        self.assertEqual(loaded.b.d[2]['e'], 1)
+        self.assertEqual(loaded.f, timedelta(seconds=2))
+        self.assertEqual(loaded.g, "/tmp")
+
+        # only directives not read yet are kept
+        lazy = Configuration.from_string(source, lazy=True)
+        self.assertEqual(lazy.a, 1)
+        out = io.StringIO()
+        lazy.dump(out, directives=True)
+        self.assertIn("a: 1\n", out.getvalue())
+        self.assertIn("- e: !ref:b.c", out.getvalue())
+
+        out = io.StringIO()
+        self.config("a: {b: [1, 2.5, null, x]}\nc: !ref:a.b").dump(out, format='json')
+        self.assertEqual(json.loads(out.getvalue()), {'a': {'b': [1, 2.5, None, 'x']}, 'c': [1, 2.5, None, 'x']})
+        out = io.StringIO()
+        self.config("a: {b: [1, x]}").a.dump(out)
+        self.assertEqual(out.getvalue(), "b:\n- 1\n- x\n")
+
+        with self.assertRaisesRegex(ConfigurationError, "cannot dump"):
+            Configuration.from_string(source).dump(io.StringIO(), format='json')
+        with self.assertRaisesRegex(ConfigurationError, "only be dumped as YAML"):
+            c.dump(io.StringIO(), format='json', directives=True)
+        with self.assertRaisesRegex(ConfigurationError, "unknown dump format"):
+            c.dump(io.StringIO(), format='toml')
+
+    def test_write_config(self):
+        c = self.config("""
+b:
+    d: [1, 2]
+    c: x
+a: 1
+        """)
+        out = io.StringIO()
+        write_config(c, out)
+        self.assertEqual(out.getvalue(), "a:\n  1\nb:\n  c:\n    x\n  d:\n    [1, 2]\n")
+        self.assertEqual(format_config(c), out.getvalue())
+        self.assertEqual(format_config(c.freeze()), out.getvalue())
+
+        deep = node = {}
+        for _ in range(5000):
+            node['n'] = node = {}
+        node['v'] = 1
+        self.assertEqual(format_config(Configuration.from_dict(deep)).count("\n"), 5002)
+
+        with self.assertRaisesRegex(ConfigurationError, "cyclic"):
+            format_config(self.config('a: &x {b: 1, c: *x}\n'))
+        self.assertEqual(format_config(self.config('a: &x {b: 1}\nc: {d: *x, e: *x}\n')).count("b:"), 3)
+
     def test_obj(self):
         c = self.config("""
 a: !obj:tests.A
@@ -310,3 +652,741 @@ a: !directory tests.py
 a: !directory
                 """,
                         ctx={'pwd': str(base_path)})
+
+    def test_child_view_cached(self):
+        c = Configuration.from_dict({'a': {'b': {'c': 1}}}, configure=False)
+        self.assertIs(c.a, c.a)
+        self.assertIs(c.a.b, c['a']['b'])
+        self.assertIs(c.a.b._parent, c.a)
+
+    def test_dunder_attributes(self):
+        c = self.config("a: {b: 1}")
+        self.assertIn('to_dict', dir(c))
+        self.assertIn('to_dict', dir(c.a))
+        self.assertFalse(hasattr(c, '__dict__'))
+        self.assertFalse(hasattr(c, '__missing_dunder__'))
+        self.assertTrue(hasattr(c, 'a'))
+
+    def test_child_view_invalidated(self):
+        c = self.config("""
+a:
+    b: 1
+        """)
+        child = c.a
+        c['a'] = {'b': 2}
+        self.assertIsNot(c.a, child)
+        self.assertEqual(c.a.b, 2)
+
+        c.a._merge({'b': 3})
+        self.assertEqual(c.a.b, 3)
+
+        del c['a']
+        self.assertNotIn('a', c)
+
+    def test_freeze(self):
+        c = self.config("""
+a: 1
+b:
+    c: !ref:a
+    items: [1, {d: 2}]
+    e-f: 3
+        """)
+        s = c.freeze()
+        self.assertIsInstance(s, FrozenConfiguration)
+        self.assertEqual(s.a, 1)
+        self.assertEqual(s.b.c, 1)
+        self.assertEqual(s.b['items'][1].d, 2)
+        self.assertEqual(s.b['e-f'], 3)
+        self.assertEqual(s.to_dict(), c.to_dict())
+        self.assertEqual(s.by_ref('b.c'), 1)
+        self.assertEqual(s.b.by_ref('..a'), 1)
+        self.assertEqual(format_config(s), format_config(c))
+
+    def test_freeze_deep(self):
+        deep = node = {}
+        for _ in range(5000):
+            node['n'] = node = {}
+        node['v'] = [1, {'w': [2]}]
+        s = Configuration.from_dict(deep).freeze()
+        node = s
+        for _ in range(5000):
+            node = node.n
+        self.assertEqual(node.v[1].w, (2,))
+        self.assertIs(node.v[1]._parent, node)
+        node = s.to_dict()
+        for _ in range(5000):
+            node = node['n']
+        self.assertEqual(node, {'v': [1, {'w': [2]}]})
+
+        # snapshot classes depend on the key set only, in any order
+        a, b = self.config("x: 1\ny: 2").freeze(), self.config("y: 3\nx: 4").freeze()
+        self.assertIs(a.__class__, b.__class__)
+        self.assertEqual((b.x, b.y), (4, 3))
+
+        with self.assertRaisesRegex(ConfigurationError, "cyclic"):
+            self.config('a: &x {b: [1], c: [*x]}\n').freeze()
+        shared = self.config('a: &x [1]\nb: {c: *x, d: *x}\n').freeze()
+        self.assertEqual((shared.b.c, shared.b.d), ((1,), (1,)))
+
+    def test_freeze_read_only(self):
+        s = self.config("""
+a:
+    b: [1, 2]
+        """).freeze()
+        with self.assertRaises(ConfigurationError):
+            s.a.b = 3
+        with self.assertRaises(ConfigurationError):
+            s['a'] = 3
+        with self.assertRaises(ConfigurationError):
+            s.by_ref('a.b', 3)
+        with self.assertRaises(TypeError):
+            s.a.b[0] = 3
+
+    def test_loader_class_cached(self):
+        def custom(loader, node):
+            return 'custom'
+
+        base = Configuration._loader_class()
+        self.assertIs(Configuration._loader_class(), base)
+
+        loader = Configuration._loader_class(constructors={'!custom': custom})
+        self.assertIsNot(loader, base)
+        self.assertIs(Configuration._loader_class(constructors={'!custom': custom}), loader)
+
+        c = Configuration.from_string("a: !custom x", constructors={'!custom': custom})
+        self.assertEqual(c.a, 'custom')
+        self.assertNotIn('!custom', Loader.yaml_constructors)
+        self.assertNotIn('!custom', base.yaml_constructors)
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'main.conf')
+            with open(path.join(tmp, 'part.conf'), 'w') as f:
+                f.write('x: 1\n')
+            with open(filename, 'w') as f:
+                f.write('a: !include:part.conf\nb: !include:part.conf\n')
+
+            cache = Configuration.enable_file_cache()
+            try:
+                c = Configuration.from_file(filename)
+                self.assertEqual(c.a.x, 1)
+                self.assertEqual(c.b.x, 1)
+                # part.conf is read once per configure pass
+                self.assertEqual(cache.stats()['misses'], 2)
+                self.assertEqual(cache.stats()['hits'], 0)
+
+                c.a['x'] = 2
+                c = Configuration.from_file(filename)
+                self.assertEqual(c.a.x, 1)
+                self.assertEqual(cache.stats()['hits'], 2)
+
+                with open(path.join(tmp, 'part.conf'), 'w') as f:
+                    f.write('x: 10\n')
+                c = Configuration.from_file(filename)
+                self.assertEqual(c.a.x, 10)
+                self.assertEqual(cache.stats()['entries'], 3)
+            finally:
+                Configuration.disable_file_cache()
+
+    def test_file_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = Configuration.enable_file_cache(max_entries=2)
+            try:
+                for i in range(3):
+                    filename = path.join(tmp, '%d.conf' % i)
+                    with open(filename, 'w') as f:
+                        f.write('a: %d\n' % i)
+                    Configuration.from_file(filename)
+                stats = cache.stats()
+                self.assertEqual(stats['entries'], 2)
+                self.assertEqual(stats['evictions'], 1)
+                self.assertEqual(stats['size'], 10)
+            finally:
+                Configuration.disable_file_cache()
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'main.conf')
+            with open(filename, 'w') as f:
+                f.write('a: !timedelta 1d\nb: !ref:a\nc: !obj:tests.A\n')
+
+            cache = Configuration.enable_disk_cache(path.join(tmp, 'cache'))
+            try:
+                c = Configuration.from_file(filename)
+                self.assertEqual((cache.hits, cache.misses), (0, 1))
+                c = Configuration.from_file(filename)
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                self.assertEqual(c.a, timedelta(days=1))
+                self.assertEqual(c.b, timedelta(days=1))
+                self.assertIs(c.c, A)
+
+                with open(filename, 'w') as f:
+                    f.write('a: 2\n')
+                c = Configuration.from_file(filename)
+                self.assertEqual((cache.hits, cache.misses), (1, 2))
+                self.assertEqual(c.a, 2)
+            finally:
+                Configuration.disable_disk_cache()
+
+    def test_disk_cache_unpicklable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'main.conf')
+            with open(filename, 'w') as f:
+                f.write('a: !func x\n')
+            constructors = {'!func': lambda loader, node: lambda: 1}
+
+            cache = Configuration.enable_disk_cache(path.join(tmp, 'cache'))
+            try:
+                for _ in range(2):
+                    c = Configuration.from_file(filename, constructors=constructors)
+                    self.assertEqual(c.a(), 1)
+                self.assertEqual((cache.hits, cache.misses), (0, 2))
+                self.assertEqual(os.listdir(path.join(tmp, 'cache')), [])
+            finally:
+                Configuration.disable_disk_cache()
+
+    def test_caches_skip_uncacheable_constructors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            logging_file = path.join(tmp, 'logging.conf')
+            with open(logging_file, 'w') as f:
+                f.write('a: !logging {version: 1}\n')
+            concat_file = path.join(tmp, 'concat.conf')
+            with open(concat_file, 'w') as f:
+                f.write('a: !concat tests.TEST_CONCAT_STRING "/x"\nb: !timedelta 1d\n')
+            plain_file = path.join(tmp, 'plain.conf')
+            with open(plain_file, 'w') as f:
+                f.write('a: !timedelta 1d\n')
+
+            disk_cache = Configuration.enable_disk_cache(path.join(tmp, 'cache'))
+            file_cache = Configuration.enable_file_cache()
+            calls = []
+            try:
+                with mock.patch('configure.configure_logging', lambda *a, **kw: calls.append(a)):
+                    for _ in range(2):
+                        Configuration.from_file(logging_file)
+                self.assertEqual(len(calls), 2)
+
+                for _ in range(2):
+                    self.assertEqual(Configuration.from_file(concat_file).a, 'base_test/x')
+
+                for _ in range(2):
+                    self.assertEqual(Configuration.from_file(plain_file).a, timedelta(days=1))
+                self.assertEqual((disk_cache.hits, disk_cache.misses), (0, 5))
+                self.assertEqual(file_cache.stats()['hits'], 1)
+                self.assertEqual(file_cache.stats()['entries'], 1)
+            finally:
+                Configuration.disable_file_cache()
+                Configuration.disable_disk_cache()
+
+    def test_env_dependencies(self):
+        os.environ['TEST_ENV_DEPS_A'] = 'one'
+        os.environ.pop('TEST_ENV_DEPS_B', None)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'main.conf')
+            with open(path.join(tmp, 'part.conf'), 'w') as f:
+                f.write('b: ENV:TEST_ENV_DEPS_B?=default\n')
+            with open(filename, 'w') as f:
+                f.write("a: ENV:TEST_ENV_DEPS_A\nc: !concat ENV:TEST_ENV_DEPS_A '-x'\ni: !include:part.conf\n")
+
+            c = Configuration.from_file(filename)
+            self.assertEqual((c.a, c.c, c.i.b), ('one', 'one-x', 'default'))
+            self.assertEqual(c.env_dependencies, {'TEST_ENV_DEPS_A': 'one', 'TEST_ENV_DEPS_B': None})
+            self.assertEqual(c.i.env_dependencies, c.env_dependencies)
+            self.assertFalse(c.env_changed())
+            self.assertEqual(self.config("a: 1").env_dependencies, {})
+
+            cache = Configuration.enable_file_cache()
+            disk_cache = Configuration.enable_disk_cache(path.join(tmp, 'cache'))
+            watcher = ConfigWatcher(filename, use_inotify=False)
+            try:
+                Configuration.from_file(filename)
+                self.assertEqual(cache.stats()['hits'], 2)
+                os.environ['TEST_ENV_DEPS_A'] = 'two'
+                self.assertTrue(c.env_changed())
+                # part.conf does not read the variable and stays cached
+                c = Configuration.from_file(filename)
+                self.assertEqual(c.a, 'two')
+                self.assertEqual(cache.stats()['hits'], 3)
+
+                Configuration.disable_file_cache()
+                c = Configuration.from_file(filename)
+                self.assertEqual((disk_cache.hits, disk_cache.misses), (2, 3))
+                os.environ['TEST_ENV_DEPS_B'] = 'set'
+                c = Configuration.from_file(filename)
+                self.assertEqual(c.i.b, 'set')
+                self.assertEqual((disk_cache.hits, disk_cache.misses), (3, 4))
+
+                self.assertTrue(watcher.check())
+                self.assertEqual((watcher.config.a, watcher.config.i.b), ('two', 'set'))
+                self.assertFalse(watcher.check())
+            finally:
+                watcher.stop()
+                Configuration.disable_file_cache()
+                Configuration.disable_disk_cache()
+                os.environ.pop('TEST_ENV_DEPS_A', None)
+                os.environ.pop('TEST_ENV_DEPS_B', None)
+
+    def test_render(self):
+        c = self.config("""
+a: "{name}-{{literal}}"
+b: {c: 1}
+d:
+    - "{name}"
+    - plain
+e: !factory:tests.A
+    a: "{name}"
+f: !ref:a
+        """, ctx={'name': 'x'})
+        self.assertEqual(c.a, "x-{literal}")
+        self.assertEqual(c.b.c, 1)
+        self.assertEqual(c.d, ["x", "plain"])
+        self.assertEqual(c.e.a, "x")
+        self.assertEqual(c.f, "x-{literal}")
+
+        base = Configuration.from_string('a: "{name}"\nb: !factory:tests.A\n    a: "{n}"', configure=False)
+        one, two = base.render({'name': 'one', 'n': 1}), base.render({'name': 'two', 'n': 2})
+        self.assertEqual((one.a, one.b.a, two.a, two.b.a), ('one', '1', 'two', '2'))
+        self.assertEqual(base.a, "{name}")
+
+        c = self.config('a: "{n:{w}.1f}|{name!r}|{l[1]}|{d[k]}"', ctx={'n': 1.25, 'w': 5, 'name': 'x',
+                                                                    'l': [1, 2], 'd': {'k': 'v'}})
+        self.assertEqual(c.a, "  1.2|'x'|2|v")
+
+        # only strings of the YAML text are templates
+        struct = node = Configuration.from_string('v: "{name}"\nw: "{name}"', configure=False)._Configuration__struct
+        for _ in range(5000):
+            node['n'] = node = {'v': struct['v']}
+        rendered = Configuration(struct).render({'name': 'x'}, configure=False)._Configuration__struct
+        for _ in range(5000):
+            rendered = rendered['n']
+        self.assertEqual(rendered, {'v': 'x'})
+        self.assertEqual(node['v'], '{name}')
+
+        os.environ['TEST_RENDER_ENVVAR'] = 'a{b}c'
+        c = self.config('a: ENV:TEST_RENDER_ENVVAR\nb: !concat ENV:TEST_RENDER_ENVVAR "x"\nc: "{name}"',
+                        ctx={'name': 'x'})
+        self.assertEqual((c.a, c.b, c.c), ('a{b}c', 'a{b}cx', 'x'))
+        c = self.config('"{name}_host": 1\nsub:\n    "{name}": "{name}"\n', ctx={'name': 'db'})
+        self.assertEqual(c.to_dict(), {'db_host': 1, 'sub': {'db': 'db'}})
+        dumped = io.StringIO()
+        Configuration.from_string('a: "{name}"', configure=False).dump(dumped)
+        self.assertEqual(dumped.getvalue(), "a: '{name}'\n")
+
+        with self.assertRaisesRegex(ConfigurationError, "cannot interpolate '{missing}'"):
+            self.config('a: "{missing}"', ctx={'name': 'x'})
+        with self.assertRaisesRegex(ConfigurationError, "cannot interpolate"):
+            self.config('a: "{name"', ctx={'name': 'x'})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'main.conf')
+            with open(filename, 'w') as f:
+                f.write('a: "{name}"\n')
+            cache = Configuration.enable_file_cache()
+            try:
+                self.assertEqual(Configuration.from_file(filename, ctx={'name': 'one'}).a, 'one')
+                self.assertEqual(Configuration.from_file(filename, ctx={'name': 'two'}).a, 'two')
+                self.assertEqual(Configuration.from_file(filename).a, '{name}')
+                self.assertEqual((cache.stats()['entries'], cache.stats()['hits']), (1, 2))
+            finally:
+                Configuration.disable_file_cache()
+
+    def test_include_graph(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {
+                'main.conf': 'a: !include:a.conf\nb: !include:b.conf\nc: !include:a.conf\n',
+                'a.conf': 'x: !include:b.conf\n',
+                'b.conf': '--- !extends:base.conf\ny: 2\n',
+                'base.conf': 'y: 1\nz: 3\n',
+            }
+            for name, content in files.items():
+                with open(path.join(tmp, name), 'w') as f:
+                    f.write(content)
+
+            cache = Configuration.enable_file_cache()
+            try:
+                c = Configuration.from_file(path.join(tmp, 'main.conf'))
+                self.assertEqual(cache.stats()['misses'], 4)
+                self.assertEqual(cache.stats()['hits'], 0)
+            finally:
+                Configuration.disable_file_cache()
+
+            self.assertEqual(c.a.x.y, 2)
+            self.assertEqual(c.c.x.z, 3)
+            self.assertIsNot(c.a.x, c.b)
+
+            graph = c.include_graph
+            main, a, b, base = (path.join(tmp, n) for n in ('main.conf', 'a.conf', 'b.conf', 'base.conf'))
+            self.assertEqual(graph.root, main)
+            self.assertEqual(graph.edges, {main: [a, b], a: [b], b: [base], base: []})
+            self.assertEqual(graph.order, [base, b, a, main])
+
+    def test_include_cycle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, content in (('a.conf', 'x: !include:b.conf\n'),
+                                  ('b.conf', 'y: !include:a.conf\n'),
+                                  ('self.conf', 'x: !include:self.conf\n')):
+                with open(path.join(tmp, name), 'w') as f:
+                    f.write(content)
+
+            with self.assertRaises(ConfigurationError) as cm:
+                Configuration.from_file(path.join(tmp, 'a.conf'))
+            self.assertIn('a.conf -> %s -> %s' % (path.join(tmp, 'b.conf'), path.join(tmp, 'a.conf')),
+                          str(cm.exception))
+
+            with self.assertRaises(ConfigurationError):
+                Configuration.from_file(path.join(tmp, 'self.conf'))
+
+    def test_recursive_anchor(self):
+        c = self.config('a: &x {b: 1, c: *x}\n')
+        self.assertEqual(c.a.c.c.b, 1)
+        c = Configuration.from_string('a: &x\n- 1\n- *x\n- !obj:os.path\n', lazy=True)
+        self.assertIs(c.a[2], path)
+        self.assertEqual(c.a[1][0], 1)
+        c = asyncio.run(Configuration.afrom_string('a: &x {b: 1, c: *x}\n'))
+        self.assertEqual(c.a.c.c.b, 1)
+
+    def test_include_deep(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            depth = 3000
+            for i in range(depth):
+                with open(path.join(tmp, '%d.conf' % i), 'w') as f:
+                    f.write('v: %d\n' % i)
+                    if i + 1 < depth:
+                        f.write('next: !include:%d.conf\n' % (i + 1))
+
+            c = Configuration.from_file(path.join(tmp, '0.conf'))
+            node = c.to_dict()
+            for _ in range(depth - 1):
+                node = node['next']
+            self.assertEqual(node, {'v': depth - 1})
+
+    def test_include_ref(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(path.join(tmp, 'inc.conf'), 'w') as f:
+                f.write('x: 1\ny: !ref:x\n')
+            main = path.join(tmp, 'main.conf')
+            with open(main, 'w') as f:
+                f.write('x: 100\ni: !include:inc.conf\nl:\n  - !include:inc.conf\n')
+
+            c = Configuration.from_file(main)
+            self.assertEqual((c.i.y, c.l[0].y), (1, 1))
+            self.assertIs(c.i._parent, c)
+            c = asyncio.run(Configuration.afrom_file(main))
+            self.assertEqual(c.i.y, 1)
+
+    def test_include_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(path.join(tmp, 'main.conf'), 'w') as f:
+                f.write(''.join('p%d: !include:p%d.conf\n' % (i, i) for i in range(10)))
+            for i in range(10):
+                with open(path.join(tmp, 'p%d.conf' % i), 'w') as f:
+                    f.write('i: %d\ncommon: !include:common.conf\n' % i)
+            with open(path.join(tmp, 'common.conf'), 'w') as f:
+                f.write('x: !timedelta 1d\n')
+
+            sequential = Configuration.from_file(path.join(tmp, 'main.conf'))
+            parallel = Configuration.from_file(path.join(tmp, 'main.conf'), max_workers=4)
+            self.assertEqual(parallel.to_dict(), sequential.to_dict())
+            self.assertEqual(parallel.include_graph.edges, sequential.include_graph.edges)
+            self.assertEqual(parallel.include_graph.order, sequential.include_graph.order)
+
+    def test_include_parallel_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(path.join(tmp, 'main.conf'), 'w') as f:
+                f.write('a: !include:ok.conf\nb: !include:missing1.conf\nc: !include:missing2.conf\n')
+            with open(path.join(tmp, 'ok.conf'), 'w') as f:
+                f.write('x: 1\n')
+
+            for max_workers in (None, 4):
+                with self.assertRaises(FileNotFoundError) as cm:
+                    Configuration.from_file(path.join(tmp, 'main.conf'), max_workers=max_workers)
+                self.assertEqual(cm.exception.filename, path.join(tmp, 'missing1.conf'))
+
+    def test_async_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(path.join(tmp, 'main.conf'), 'w') as f:
+                f.write('a: !include:a.conf\nb: !include:b.conf\nc: !coro 21\nd: !ref:c\n')
+            with open(path.join(tmp, 'a.conf'), 'w') as f:
+                f.write('x: !include:b.conf\n')
+            with open(path.join(tmp, 'b.conf'), 'w') as f:
+                f.write('y: !timedelta 1d\n')
+
+            constructors = {'!coro': lambda loader, node: double(int(loader.construct_scalar(node)))}
+            c = asyncio.run(Configuration.afrom_file(path.join(tmp, 'main.conf'), constructors=constructors))
+            self.assertEqual(c.a.x.y, timedelta(days=1))
+            self.assertEqual(c.b.y, timedelta(days=1))
+            self.assertEqual(c.c, 42)
+            self.assertEqual(c.d, 42)
+            self.assertEqual(c.include_graph.order, [path.join(tmp, n) for n in ('b.conf', 'a.conf', 'main.conf')])
+
+            c = asyncio.run(Configuration.afrom_string('a: !include:b.conf', pwd=tmp))
+            self.assertEqual(c.a.y, timedelta(days=1))
+
+    def test_async_load_does_not_block_loop(self):
+        def slow(loader, node):
+            time.sleep(0.3)
+            return loader.construct_scalar(node)
+
+        async def main():
+            gaps = []
+
+            async def tick():
+                last = time.monotonic()
+                while True:
+                    await asyncio.sleep(0.01)
+                    now = time.monotonic()
+                    gaps.append(now - last)
+                    last = now
+
+            ticker = asyncio.ensure_future(tick())
+            start = time.monotonic()
+            c = await Configuration.afrom_string('a: !slow value', constructors={'!slow': slow})
+            elapsed = time.monotonic() - start
+            ticker.cancel()
+            return c, elapsed, max(gaps)
+
+        c, elapsed, max_gap = asyncio.run(main())
+        self.assertEqual(c.a, 'value')
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(max_gap, 0.1)
+
+    def test_watcher(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main, a, b = (path.join(tmp, n) for n in ('main.conf', 'a.conf', 'b.conf'))
+            with open(main, 'w') as f:
+                f.write('a: !include:a.conf\nb: !include:b.conf\n')
+            with open(a, 'w') as f:
+                f.write('x: 1\n')
+            with open(b, 'w') as f:
+                f.write('y: 1\n')
+
+            watcher = ConfigWatcher(main, use_inotify=False)
+            self.assertEqual(watcher.files, {main, a, b})
+            self.assertEqual(watcher.config.a.x, 1)
+            self.assertFalse(watcher.check())
+
+            calls = []
+            watcher.subscribe('a.x', lambda old, new: calls.append(('a.x', old, new)))
+            watcher.subscribe('b', lambda old, new: calls.append(('b', old, new)))
+            b_struct = watcher._structs[b]
+
+            with open(a, 'w') as f:
+                f.write('x: 20\n')
+            self.assertTrue(watcher.check())
+            self.assertEqual(watcher.config.a.x, 20)
+            self.assertEqual(calls, [('a.x', 1, 20)])
+            self.assertIs(watcher._structs[b], b_struct)
+
+            with open(main, 'w') as f:
+                f.write('a: !include:a.conf\n')
+            self.assertTrue(watcher.check())
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(calls[1][0], 'b')
+            self.assertEqual(calls[1][1], {'y': 1})
+            self.assertIsNone(calls[1][2])
+            self.assertEqual(watcher.files, {main, a})
+
+    def test_watcher_reuses_factories(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main = path.join(tmp, 'main.conf')
+            with open(main, 'w') as f:
+                f.write('a: !factory:tests.A {a: 1}\nb: !factory:tests.A {a: 2}\n')
+
+            watcher = ConfigWatcher(main, use_inotify=False)
+            a, b = watcher.config.a, watcher.config.b
+            with open(main, 'w') as f:
+                f.write('a: !factory:tests.A {a: 1}\nb: !factory:tests.A {a: 20}\n')
+            self.assertTrue(watcher.check())
+            self.assertIs(watcher.config.a, a)
+            self.assertIsNot(watcher.config.b, b)
+            self.assertEqual(watcher.config.b.a, 20)
+
+            with open(main, 'w') as f:
+                f.write('a: !factory:tests.u {a: 1}\n')
+            self.assertTrue(watcher.check())
+            a = watcher.config.a
+            self.assertEqual(a.a, 1)
+            with open(main, 'w') as f:
+                f.write('a: !factory:tests.u {a: 1}\nb: 2\n')
+            self.assertTrue(watcher.check())
+            self.assertIsNot(watcher.config.a, a)
+
+    def test_watcher_thread(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main = path.join(tmp, 'main.conf')
+            with open(main, 'w') as f:
+                f.write('a: 1\n')
+
+            for use_inotify in (True, False):
+                watcher = ConfigWatcher(main, interval=0.05, use_inotify=use_inotify)
+                changed = threading.Event()
+                watcher.subscribe('a', lambda old, new: changed.set())
+                watcher.start()
+                try:
+                    with open(main, 'w') as f:
+                        f.write('a: %d0\n' % watcher.config.a)
+                    self.assertTrue(changed.wait(5))
+                finally:
+                    watcher.stop()
+
+    def test_diff(self):
+        old = self.config("""
+a: 1
+b:
+    c: 2
+    d: [1, 2]
+e:
+    f: 1
+g: 3
+        """)
+        new = self.config("""
+a: 1
+b:
+    c: 3
+    d: [1, 2]
+    h: 4
+e:
+    f: 1
+i: 5
+        """)
+        changes = old.diff(new)
+        self.assertEqual(changes.added, {('b', 'h'): 4, ('i',): 5})
+        self.assertEqual(changes.removed, {('g',): 3})
+        self.assertEqual(changes.changed, {('b', 'c'): (2, 3)})
+        self.assertEqual(len(changes), 4)
+        self.assertFalse(old.diff(old))
+        self.assertFalse(new.diff(self.config("a: 1").merge(new)))
+
+        old = Configuration.from_dict({'a.b': 1, 'a': {'b': 2}, 1: {2: 'x'}})
+        new = Configuration.from_dict({'a.b': 3, 'a': {'b': 2}, 1: {2: 'y', 3: 'z'}})
+        changes = old.diff(new)
+        self.assertEqual(changes.changed, {('a.b',): (1, 3), (1, 2): ('x', 'y')})
+        self.assertEqual(changes.added, {(1, 3): 'z'})
+        self.assertEqual(old.apply_patch(changes).to_dict(), new.to_dict())
+
+    def test_apply_patch(self):
+        old = self.config("""
+a: 1
+b:
+    c: 2
+    d: [1, 2]
+e:
+    f: 1
+g: 3
+        """)
+        new = self.config("""
+a: 2
+b:
+    c: 2
+    d: [1, 3]
+e:
+    f: 1
+i:
+    j: 5
+        """)
+        patched = old.apply_patch(old.diff(new))
+        self.assertEqual(patched.to_dict(), new.to_dict())
+        self.assertEqual(old.g, 3)
+        self.assertEqual(old.b.d, [1, 2])
+        self.assertIs(patched._Configuration__struct['e'], old._Configuration__struct['e'])
+
+    def test_ref_chain(self):
+        config = self.config("""
+a: !ref:b
+b: !ref:c.d
+c:
+    d: !obj:tests.A
+    e: !ref:..a
+        """)
+        self.assertIs(config.a, A)
+        self.assertIs(config.b, A)
+        self.assertIs(config.c.e, A)
+        refs = "\n".join("r%d: !ref:r%d" % (i, i + 1) for i in range(3000))
+        config = self.config(refs + "\nr3000: 1")
+        self.assertEqual(config.r0, 1)
+        self.assertEqual(config.r2999, 1)
+
+    def test_ref_cycle(self):
+        with self.assertRaisesRegex(ConfigurationError, "reference cycle: b -> a -> b"):
+            self.config("""
+a: !ref:b
+b: !ref:a
+            """)
+        with self.assertRaisesRegex(ConfigurationError, "goes above the root"):
+            self.config("a: !ref:..b")
+
+    def test_import_string_cache(self):
+        self.assertIs(import_string('tests.A'), A)
+        self.assertIs(import_string('tests:a'), a)
+        self.assertIs(import_string('os.path'), path)
+
+        self.assertIsNone(import_string('tests_dynamic_module.x', silent=True))
+        module = ModuleType('tests_dynamic_module')
+        module.x = 1
+        sys.modules['tests_dynamic_module'] = module
+        try:
+            self.assertEqual(import_string('tests_dynamic_module.x'), 1)
+            module = ModuleType('tests_dynamic_module')
+            module.x = 2
+            sys.modules['tests_dynamic_module'] = module
+            self.assertEqual(import_string('tests_dynamic_module.x'), 2)
+        finally:
+            del sys.modules['tests_dynamic_module']
+
+        with mock.patch('tests.A', kw):
+            self.assertIs(import_string('tests.A'), kw)
+            self.assertEqual(self.config('a: !obj:tests.A\n').a, kw)
+        self.assertIs(import_string('tests.A'), A)
+
+        with self.assertRaises(ImportStringError) as cm:
+            import_string('tests.missing_name')
+        self.assertIsNone(cm.exception._message)
+        self.assertIn("- 'tests' found in", str(cm.exception))
+        self.assertIn("- 'tests.missing_name' not found.", str(cm.exception))
+
+    def test_tracing(self):
+        events = []
+
+        class Recorder(Tracer):
+            def start(self, phase, name, path, source):
+                events.append(('start', phase, name, path, source))
+
+            def end(self, phase, name, path, source, duration):
+                events.append(('end', phase, name, path, source))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            main, inc = path.join(tmp, 'main.conf'), path.join(tmp, 'inc.conf')
+            with open(main, 'w') as f:
+                f.write('a:\n  b: !factory:tests.A {a: 1}\nc: !include:inc.conf\nd: !envvar HOME\n')
+            with open(inc, 'w') as f:
+                f.write('e: !obj:tests.a\n')
+            Configuration.enable_tracing(Recorder())
+            try:
+                Configuration.from_file(main)
+            finally:
+                Configuration.disable_tracing()
+
+            ends = [e[1:] for e in events if e[0] == 'end']
+            self.assertEqual(len(ends), len(events) / 2)
+            self.assertIn(('directive', 'Factory(tests.A)', 'a.b', main), ends)
+            self.assertIn(('directive', 'Obj(tests.a)', 'e', inc), ends)
+            self.assertIn(('directive', 'Include(inc.conf)', 'c', main), ends)
+            self.assertIn(('parse', inc, None, inc), ends)
+            self.assertIn(('constructor', '!envvar', None, None), ends)
+            self.assertIn(('configure', main, None, main), ends)
+            self.assertIn(('includes', main, None, main), ends)
+
+            events.clear()
+            Configuration.from_file(main)
+            self.assertEqual(events, [])
+
+            tracer = Configuration.enable_tracing()
+            try:
+                Configuration.from_file(main)
+            finally:
+                Configuration.disable_tracing()
+            self.assertIsInstance(tracer, SlowestTracer)
+            self.assertEqual(len(tracer.slowest), len(ends))
+            durations = [item[0] for item in tracer.slowest]
+            self.assertEqual(durations, sorted(durations, reverse=True))
+            self.assertIn('directive   Factory(tests.A) at a.b in %s' % main, tracer.format())